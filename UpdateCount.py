@@ -1,193 +1,1032 @@
+import time
+# process start, for the startup report (taken before the other imports)
+startup_started = time.time()
+
 import base64
+import sys
+import csv
+import glob
+import gzip
+import hashlib
+import importlib
 import io
 import os
 import random
-import string
-import time
 import sqlite3
 import logging
-
-import requests
+import queue
+import json
+import asyncio
+import multiprocessing
 import threading
 
-from uuid import uuid4
-from bs4 import BeautifulSoup
+from html import escape as escape_html
+from html.parser import HTMLParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict
+from itertools import accumulate
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, \
-    InputTextMessageContent, ParseMode
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, InlineQueryHandler, \
-    CallbackQueryHandler
-from telegram.utils.helpers import escape_markdown
-from PIL import Image, ImageFont, ImageDraw, ImageFilter, ImageOps
-
+    InlineQueryResultCachedPhoto, InputTextMessageContent
+from telegram.ext import Updater, Dispatcher, CommandHandler, MessageHandler, Filters, CallbackContext, \
+    InlineQueryHandler, CallbackQueryHandler
+from telegram import Bot
+from telegram.utils.request import Request
+from telegram.error import RetryAfter, ChatMigrated, Unauthorized, BadRequest, NetworkError
+
+
+# module imported on its first attribute access: requests, bs4 and PIL are only needed to scrape and render, so
+# the bot starts serving without them and warm_caches() imports them in the background
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _import(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._import(), attribute)
+
+
+requests = LazyModule('requests')
+bs4 = LazyModule('bs4')
+Image = LazyModule('PIL.Image')
+ImageFont = LazyModule('PIL.ImageFont')
+ImageDraw = LazyModule('PIL.ImageDraw')
+ImageFilter = LazyModule('PIL.ImageFilter')
+startup_imported = time.time()
 ''' 
 # load environmental variables (.env file)
 # load bot-token
 '''
 load_dotenv()
 bot_token = os.environ.get("bot-token")
-
-data = {}
-update_delay = 3600 * 24
-
+# Bot API server, overridable to run against a local fake server
+bot_api_url = os.environ.get("bot-api-url", "https://api.telegram.org/bot")
+# "threads" (long polling with the dispatcher thread pool) or "asyncio" (webhook server on an event loop)
+runtime = os.environ.get("runtime", "threads")
+# telegram user ids allowed to use admin commands (comma separated)
+admin_ids = {int(i) for i in os.environ.get("admin-ids", "").split(",") if i.strip().isdigit()}
+
+# refresh scheduler: the interval adapts between update_min_delay and update_max_delay (halved after an update
+# that changed rows, doubled after one that didn't), failures are retried after update_retry_delay, doubling up to
+# update_max_delay, and every delay is spread by +-update_jitter. The last success is persisted so a restart
+# doesn't scrape again right away, /refresh wakes the scheduler.
+update_min_delay = int(os.environ.get("update-min-interval", str(3600)))
+update_max_delay = int(os.environ.get("update-interval", str(3600 * 24)))
+update_delay = update_max_delay
+update_retry_delay = 300
+update_jitter = 0.1
+update_failures = 0
+update_last_success = None
+update_next_run = None
+refresh_event = threading.Event()
+
+# keys of table rows that aren't countries (the totals row, stored by older versions, is skipped on load too)
+skipped_countries = ('total:', '-')
+
+# incremental scrape state: per-row hashes (conditional GET validators and page hashes are kept by the source)
+scrape_url = "https://www.worldometers.info/coronavirus/?zarsrc=130#countries"
+row_hashes = {}
+scrape_table_id = "main_table_countries_today"
+parse_backend = os.environ.get("parse-backend", "stream")
+row_fields = ('total_case', 'total_death', 'total_recovery', 'total_test', 'critical_case', 'active_case',
+              'population', 'country_name')
+
+# metrics: counters and histograms keyed by (name, labels), served in Prometheus text format on
+# metrics_host:metrics_port (0 disables the endpoint) and shown by /stats
+metrics_lock = threading.Lock()
+metrics_counters = {}
+metrics_histograms = {}
+metrics_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+metrics_host = os.environ.get("metrics-host", "127.0.0.1")
+metrics_port = int(os.environ.get("metrics-port", "9108"))
+metrics_help = OrderedDict([
+    ('bot_requests_total', ('counter', "Updates handled, by handler")),
+    ('bot_handler_seconds', ('histogram', "Time spent in a handler on the dispatcher thread")),
+    ('bot_cache_lookups_total', ('counter', "Cache lookups, by cache (file_id, render, card_store, asset) and result")),
+    ('bot_render_seconds', ('histogram', "Card render time")),
+    ('bot_encode_seconds', ('histogram', "Card encode time (part of the render time), by format")),
+    ('bot_card_bytes_total', ('counter', "Bytes of the encoded cards, by format")),
+    ('bot_upload_seconds', ('histogram', "Photo upload time")),
+    ('bot_render_queue_jobs_total', ('counter', "Render executor jobs, by result")),
+    ('bot_render_queue_depth', ('gauge', "Jobs waiting in the render executor")),
+    ('bot_render_queue_wait_seconds', ('histogram', "Time a job waited in the render executor before it started")),
+    ('bot_scrape_seconds', ('histogram', "Scrape time, by stage")),
+    ('bot_scrapes_total', ('counter', "Scrapes, by result")),
+    ('bot_rows_changed_total', ('counter', "Rows changed by scrapes")),
+    ('bot_snapshot_rows', ('gauge', "Countries in the published snapshot")),
+    ('bot_snapshot_version', ('gauge', "Version of the published snapshot")),
+    ('bot_data_age_seconds', ('gauge', "Seconds since the last successful scrape")),
+    ('bot_next_update_seconds', ('gauge', "Seconds until the next scheduled scrape")),
+    ('bot_update_failures', ('gauge', "Consecutive failed scrapes")),
+    ('bot_pushes_total', ('counter', "Subscription pushes, by result")),
+    ('bot_startup_seconds', ('gauge', "Seconds from the process start to the end of imports, serving and the first "
+                                      "response")),
+])
+
+# trace id of the update being handled by the current thread, carried through the render executor and logged
+trace_local = threading.local()
+
+
+def count_metric(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metrics_counters[key] = metrics_counters.get(key, 0) + value
+
+
+def observe_metric(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        histogram = metrics_histograms.get(key)
+        if histogram is None:
+            histogram = metrics_histograms[key] = [[0] * metrics_buckets.__len__(), 0.0, 0]
+        for i, bound in enumerate(metrics_buckets):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def label_text(labels):
+    if labels.__len__() == 0:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + "}"
+
+
+# counters, histograms and gauges, including the older stats dicts of the caches and the render executor
+def collect_metrics():
+    with metrics_lock:
+        counters = dict(metrics_counters)
+        histograms = {key: (list(histogram[0]), histogram[1], histogram[2])
+                      for key, histogram in metrics_histograms.items()}
+    for cache, stats in (('file_id', image_cache_stats), ('asset', asset_stats)):
+        for result, field in (('hit', 'hits'), ('miss', 'misses')):
+            counters[('bot_cache_lookups_total', (('cache', cache), ('result', result)))] = stats[field]
+    for result in ('queued', 'merged', 'rejected', 'completed'):
+        counters[('bot_render_queue_jobs_total', (('result', result),))] = render_queue_stats[result]
+    current = snapshot
+    counters[('bot_render_queue_depth', ())] = render_queue.qsize()
+    counters[('bot_snapshot_rows', ())] = current.rows.__len__()
+    counters[('bot_snapshot_version', ())] = current.version
+    if update_last_success is not None:
+        counters[('bot_data_age_seconds', ())] = time.time() - update_last_success
+    if update_next_run is not None:
+        counters[('bot_next_update_seconds', ())] = max(0.0, update_next_run - time.time())
+    counters[('bot_update_failures', ())] = update_failures
+    for stage, value in startup_stages.items():
+        counters[('bot_startup_seconds', (('stage', stage),))] = value
+    return counters, histograms
+
+
+def metrics_text():
+    counters, histograms = collect_metrics()
+    lines = []
+    for name, (kind, description) in metrics_help.items():
+        lines.append("# HELP {0} {1}".format(name, description))
+        lines.append("# TYPE {0} {1}".format(name, kind))
+        if kind == 'histogram':
+            for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, bucket in zip(metrics_buckets, buckets):
+                    lines.append("{0}_bucket{1} {2}".format(name, label_text(labels + (('le', str(bound)),)), bucket))
+                lines.append("{0}_bucket{1} {2}".format(name, label_text(labels + (('le', '+Inf'),)), count))
+                lines.append("{0}_sum{1} {2}".format(name, label_text(labels), total))
+                lines.append("{0}_count{1} {2}".format(name, label_text(labels), count))
+        else:
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append("{0}{1} {2}".format(name, label_text(labels), value))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(body.__len__()))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server():
+    if metrics_port == 0:
+        return None
+    try:
+        server = ThreadingHTTPServer((metrics_host, metrics_port), MetricsHandler)
+    except OSError as e:
+        logger.error("Metrics: " + str(e))
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Metrics: serving http://{0}:{1}/metrics".format(metrics_host, metrics_port))
+    return server
+
+
+def new_trace():
+    return os.urandom(4).hex()
+
+
+def current_trace():
+    return getattr(trace_local, 'trace_id', None)
+
+
+def set_trace(trace_id):
+    trace_local.trace_id = trace_id
+
+
+# database access: one connection per thread, in WAL mode so readers don't wait on the daily writer.
+# Statements are constant SQL with ? parameters, so sqlite3 reuses each connection's prepared statements.
+database_path = 'Corona.db'
+database_local = threading.local()
+
+# static country table (name -> (flag_path, link)), preloaded so flag lookups cost no query
+country_flags = {}
+default_flag = ("/countries/International_flag.png",
+                "https://upload.wikimedia.org/wikipedia/commons/e/ef/International_Flag_of_Planet_Earth.svg")
+
+
+def get_connection():
+    connection = getattr(database_local, 'connection', None)
+    if connection is None:
+        connection = sqlite3.connect(database_path, timeout=30)
+        connection.execute("pragma journal_mode=wal")
+        connection.execute("pragma synchronous=normal")
+        database_local.connection = connection
+    return connection
+
+
+def load_flags():
+    for name, flag_path, link in get_connection().execute("select name, flag_path, link from country"):
+        country_flags[name] = (flag_path, link)
+    logger.info(str(country_flags.__len__()) + " flags loaded")
+
+
+def get_flag_path(country):
+    return country_flags.get(country, default_flag)[0]
+
+
+# one country of a snapshot, fields are also readable as row['field']
+class CountryRow:
+    __slots__ = ('country', 'total_case', 'total_death', 'total_recovery', 'total_test', 'critical_case',
+                 'active_case', 'population', 'update_time', 'country_name')
+
+    def __init__(self, country, total_case, total_death, total_recovery, total_test, critical_case, active_case,
+                 population, update_time, country_name):
+        self.country = country
+        self.total_case = total_case
+        self.total_death = total_death
+        self.total_recovery = total_recovery
+        self.total_test = total_test
+        self.critical_case = critical_case
+        self.active_case = active_case
+        self.population = population
+        self.update_time = update_time
+        self.country_name = country_name
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+
+# metrics of /top and /compare: name -> (row field, label), plus per million people figures of some of them
+rank_metrics = OrderedDict([
+    ('cases', ('total_case', "Total case")),
+    ('deaths', ('total_death', "Total death")),
+    ('recovered', ('total_recovery', "Total recovery")),
+    ('tests', ('total_test', "Total test")),
+    ('active', ('active_case', "Active case")),
+    ('critical', ('critical_case', "Critical case")),
+    ('population', ('population', "Population")),
+])
+per_capita_metrics = ('cases', 'deaths', 'tests', 'active')
+metric_labels = OrderedDict([(metric, label) for metric, (field, label) in rank_metrics.items()] +
+                            [(metric + '_per_million', rank_metrics[metric][1] + " / 1M")
+                             for metric in per_capita_metrics])
+metric_aliases = {'case': 'cases', 'death': 'deaths', 'recovery': 'recovered', 'recoveries': 'recovered',
+                  'test': 'tests', 'critical_cases': 'critical', 'active_cases': 'active'}
+# accepted spellings of "per million" (metric_per_<suffix>)
+per_million_suffixes = ('million', '1m', '1_million', '1000000')
+
+
+# typed values of every row (per capita ones where the population is known) and, per metric, the keys of the
+# rows having a population (so no world, continents or ships) sorted by decreasing value
+def build_rankings(rows):
+    values = {}
+    for key, row in rows.items():
+        item = {metric: parse_count(row[field]) for metric, (field, label) in rank_metrics.items()}
+        if item['population']:
+            for metric in per_capita_metrics:
+                if item[metric] is not None:
+                    item[metric + '_per_million'] = item[metric] * 1000000.0 / item['population']
+        values[key] = item
+    order = {}
+    for metric in metric_labels.keys():
+        ranked = [key for key, item in values.items() if item['population'] and item.get(metric) is not None]
+        order[metric] = sorted(ranked, key=lambda k: values[k][metric], reverse=True)
+    return {'values': values, 'order': order}
+
+
+# complete, never mutated view of the data; the updater publishes a new one with a single reference swap
+class Snapshot:
+    __slots__ = ('version', 'rows', 'rankings')
+
+    def __init__(self, version, rows, rankings):
+        self.version = version
+        self.rows = rows
+        self.rankings = rankings
+
+
+# readers take `current = snapshot` once and use it for the whole request
+snapshot = Snapshot(0, {}, build_rankings({}))
+snapshot_lock = threading.Lock()
+snapshot_min_ratio = 0.5
+
+
+# sanity checks of a complete set of rows before it replaces the current snapshot
+def validate_rows(rows):
+    if 'world' not in rows:
+        logger.error("Snapshot rejected: world row missing")
+        return False
+    if rows.__len__() < snapshot.rows.__len__() * snapshot_min_ratio:
+        logger.error("Snapshot rejected: {0} rows, previous snapshot had {1}".format(
+            rows.__len__(), snapshot.rows.__len__()))
+        return False
+    return True
+
+
+# validate and publish a complete set of rows, returns the new snapshot (None if rejected)
+def publish_snapshot(rows):
+    global snapshot
+    rankings = build_rankings(rows)
+    with snapshot_lock:
+        if not validate_rows(rows):
+            return None
+        snapshot = Snapshot(snapshot.version + 1, rows, rankings)
+        return snapshot
+
+
+# telegram file_id of uploaded cards, keyed by (country, update_time) and persisted in Corona.db
 image_cache = {}
+image_cache_stats = {'hits': 0, 'misses': 0}
+image_cache_lock = threading.Lock()
+
+# pre-rendered cards, keyed by (country, update_time)
+render_cache = {}
+render_workers = 4
+render_generation = 0
+render_lock = threading.Lock()
+# worker processes of the render farm (0 renders with render_workers threads instead), seconds per card
+render_processes = int(os.environ.get("render-processes", "0"))
+render_job_timeout = 30
+
+# optional on-disk card store (set card-store-dir to enable), bounded by card_store_limit bytes
+card_store_dir = os.environ.get("card-store-dir")
+card_store_limit = 256 * 1024 * 1024
+card_store_index = None
+card_store_bytes = 0
+card_store_lock = threading.Lock()
+
+
+# load the persisted file_id cache, dropping entries of outdated data
+def load_image_cache():
+    connection = get_connection()
+    with image_cache_lock:
+        with connection:
+            connection.execute("create table if not exists image_cache (country, update_time, file_id, "
+                               "primary key (country, update_time))")
+        for country, update_time, file_id in connection.execute(
+                "select country, update_time, file_id from image_cache"):
+            image_cache[(country, update_time)] = file_id
+    prune_image_cache()
+    logger.info(str(image_cache.__len__()) + " cached images loaded")
+
+
+# remove cached file_ids whose data is no longer current
+def prune_image_cache():
+    with image_cache_lock:
+        rows = snapshot.rows
+        stale = [key for key in image_cache.keys() if key[0] not in rows or rows[key[0]].update_time != key[1]]
+        for key in stale:
+            del image_cache[key]
+        if stale.__len__() > 0:
+            with get_connection() as connection:
+                connection.executemany("delete from image_cache where country=? and update_time=?", stale)
+    logger.info(image_cache_report())
+
+
+def image_cache_report():
+    lookups = image_cache_stats['hits'] + image_cache_stats['misses']
+    ratio = image_cache_stats['hits'] * 100.0 / lookups if lookups > 0 else 0
+    return "Image cache: {0} entries, {1:.1f}% hit ratio, {2} uploads saved".format(
+        image_cache.__len__(), ratio, image_cache_stats['hits'])
 
 
 # fetch cache image if it exists in cache
-def get_cached_image(_query):
-    try:
-        return image_cache[parse_string(_query)]['file_id']
-    except:
-        return None
+def get_cached_image(key):
+    file_id = image_cache.get(key)
+    with image_cache_lock:
+        if file_id is None:
+            image_cache_stats['misses'] += 1
+        else:
+            image_cache_stats['hits'] += 1
+    return file_id
 
 
 # cache image if it doesn't exist in cache
-def cache_image(_query, _img):
-    try:
-        item = image_cache[parse_string(_query)]
-    except:
-        item = None
-    if item is None:
-        c = (_img['photo']).__len__()
-        image_cache[_query] = {'file_id': _img['photo'][c-1]['file_id']}
+def cache_image(key, _img):
+    if key in image_cache:
+        return
+    c = (_img['photo']).__len__()
+    file_id = _img['photo'][c-1]['file_id']
+    with image_cache_lock:
+        image_cache[key] = file_id
+        with get_connection() as connection:
+            connection.execute("insert or replace into image_cache (country, update_time, file_id) values (?,?,?)",
+                               (key[0], key[1], file_id))
+    drop_inline_results(key[0])
 
 
-# Setup database table
-def setup_database(setup_cursor, setup_connection):
-    try:
-        setup_cursor.execute(
-            "create table corona (country, total_case, total_death, total_recovery, total_test, critical_case,"
-            " active_case, population, update_time, country_name)")
-        setup_connection.commit()
-    except Exception as e:
-        print(e.with_traceback())
-        exit(-2)
+count_fields = ('total_case', 'total_death', 'total_recovery', 'total_test', 'critical_case', 'active_case',
+                'population')
+schema_version = 1
+
+
+# "96,342,050" -> 96342050, missing values ("-", "N/A", "") -> None
+def parse_count(text):
+    value = str(text).replace(',', '').replace('+', '').strip()
+    return int(value) if value.isdigit() else None
+
+
+def format_count(value):
+    return "-" if value is None else "{0:,}".format(value)
+
+
+# Setup database tables (typed latest snapshot + daily history), migrating the untyped corona table
+def setup_database(setup_connection):
+    version = setup_connection.execute("pragma user_version").fetchone()[0]
+    if version >= schema_version:
+        return
+    columns = ", ".join(field + " integer" for field in count_fields)
+    # sqlite3 doesn't open a transaction for DDL, begin one so that the migration is all or nothing
+    with setup_connection:
+        setup_connection.execute("begin")
+        tables = {name for (name,) in setup_connection.execute("select name from sqlite_master where type='table'")}
+        old_table = 'corona' in tables or 'corona_untyped' in tables
+        if 'corona_untyped' in tables:
+            # left by a migration that failed half way (before it was atomic): start it over
+            logger.info("Resuming the migration of the corona table to typed schema")
+            setup_connection.execute("drop table if exists corona")
+        elif old_table:
+            logger.info("Migrating corona table to typed schema")
+            setup_connection.execute("alter table corona rename to corona_untyped")
+        setup_connection.execute(
+            "create table corona (country text primary key, " + columns + ", update_time text, country_name text)")
+        setup_connection.execute(
+            "create table if not exists history (country text not null, date text not null, " + columns +
+            ", primary key (country, date)) without rowid")
+        if old_table:
+            rows = [(item[0],) + tuple(parse_count(value) for value in item[1:8]) + (item[8], item[9])
+                    for item in setup_connection.execute(
+                        "select country, total_case, total_death, total_recovery, total_test, critical_case, "
+                        "active_case, population, update_time, country_name from corona_untyped")]
+            write_rows(setup_connection, rows)
+            write_history(setup_connection, rows)
+            setup_connection.execute("drop table corona_untyped")
+            logger.info(str(rows.__len__()) + " rows migrated")
+        setup_connection.execute("pragma user_version = " + str(schema_version))
+
+
+# upsert the latest rows, rows: (country, *count_fields, update_time, country_name)
+def write_rows(w_connection, rows):
+    w_connection.executemany(
+        "insert or replace into corona (country, " + ", ".join(count_fields) + ", update_time, country_name) "
+        "values (?,?,?,?,?,?,?,?,?,?)", rows)
+
+
+# record the rows in the daily history (one row per country and day), dated by date or their update_time (rows
+# without one are left out)
+def write_history(w_connection, rows, date=None):
+    write_history_rows(w_connection, ((row[0], date or row[8][:10]) + tuple(row[1:8]) for row in rows
+                                      if date or row[8]))
+
+
+# history rows: (country, date, *count_fields)
+def write_history_rows(w_connection, rows):
+    w_connection.executemany(
+        "insert or replace into history (country, date, " + ", ".join(count_fields) + ") values (?,?,?,?,?,?,?,?,?)",
+        rows)
+
+
+# daily history of a country from since to until (YYYY-MM-DD, both included), oldest first
+def load_history(h_connection, country, since, until):
+    return h_connection.execute(
+        "select date, " + ", ".join(count_fields) + " from history where country=? and date>=? and date<=? "
+        "order by date", (country, since, until)).fetchall()
 
 
 # load database (local: SQLite)
 def load_data():
-    logger.info("Initializing database connection")
-    load_connection = sqlite3.connect('Corona.db')
-    logger.info("Database connection initialized")
-    load_cursor = load_connection.cursor()
-    logger.info("Database cursor initialized")
+    load_connection = get_connection()
     try:
+        setup_database(load_connection)
         logger.info("Loading data")
-        load_cursor.execute("select * from corona")
-        count = 0
-        for item in load_cursor.fetchall():
-            data[item[0]] = {
-                'country': item[0],
-                'total_case': item[1],
-                'total_death': item[2],
-                'total_recovery': item[3],
-                'total_test': item[4],
-                'critical_case': item[5],
-                'active_case': item[6],
-                'population': item[7],
-                'update_time': item[8],
-                'country_name': item[9],
-            }
-            count += 1
-
-        logger.info(str(count) + " item loaded")
-    except:
-        logger.error("Error loading data(Database empty)")
+        rows = {}
+        for item in load_connection.execute(
+                "select country, " + ", ".join(count_fields) + ", update_time, country_name from corona"):
+            if item[0] in skipped_countries:
+                continue
+            rows[item[0]] = CountryRow(item[0], *(format_count(value) for value in item[1:8]), item[8], item[9])
+        if rows.__len__() > 0:
+            publish_snapshot(rows)
+
+        logger.info(str(rows.__len__()) + " item loaded")
+        load_flags()
+    except sqlite3.Error as e:
+        logger.error("Error loading data: " + str(e))
 
 
 def parse_item_string(item_content, index):
-    item_data = str(item_content[index].get_text()).strip()
+    item_data = str(item_content[index]).strip()
     return "-" if item_data.__len__() == 0 else item_data
 
 
+# html of the main countries table (the whole page if it isn't found)
+def countries_table_html(html):
+    start = html.find('id="' + scrape_table_id + '"')
+    if start < 0:
+        return html
+    start = html.rfind('<table', 0, start)
+    end = html.find('</table>', start)
+    return html[start:] if end < 0 else html[start:end + len('</table>')]
+
+
+# BeautifulSoup backend: builds the DOM of the page and walks its rows
+def parse_rows_soup(html):
+    soup = bs4.BeautifulSoup(html, 'html.parser')
+    table = soup.find('table', id=scrape_table_id)
+    for data_item in (soup if table is None else table).findAll('tr'):
+        yield tuple(str(td.get_text()).strip() for td in data_item.findAll('td'))
+
+
+# event based extractor: collects the cell texts of each row, nothing else is kept
+class RowExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows = []
+        self.row = None
+        self.cell = None
+
+    def close_cell(self):
+        if self.cell is not None:
+            self.row.append(''.join(self.cell).strip())
+            self.cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'tr':
+            self.row = []
+            self.cell = None
+        elif tag == 'td' and self.row is not None:
+            self.close_cell()
+            self.cell = []
+
+    def handle_endtag(self, tag):
+        if tag == 'td' and self.row is not None:
+            self.close_cell()
+        elif tag == 'tr' and self.row is not None:
+            self.close_cell()
+            self.rows.append(tuple(self.row))
+            self.row = None
+
+    def handle_data(self, content):
+        if self.cell is not None:
+            self.cell.append(content)
+
+
+# streaming backend: only feeds the main countries table to the extractor, yielding rows as they complete
+def parse_rows_stream(html, chunk_size=64 * 1024):
+    table = countries_table_html(html)
+    extractor = RowExtractor()
+    for offset in range(0, table.__len__(), chunk_size):
+        extractor.feed(table[offset:offset + chunk_size])
+        yield from extractor.rows
+        extractor.rows = []
+    extractor.close()
+    yield from extractor.rows
+
+
+parse_backends = {'soup': parse_rows_soup, 'stream': parse_rows_stream}
+
+
 def parse_string(_item_):
     return str(_item_).lower().strip().replace(' ', '_')
 
 
-def update_count(u_cursor, u_connection):
+# hash of the values of a row, update_time excluded
+def row_hash(item):
+    values = [item[field] for field in row_fields]
+    return hashlib.sha1('|'.join(values).encode('utf-8')).hexdigest()
+
+
+# ingestion sources, run by ingest(): fetch() returns (result, payload) with result fetched, not_modified or
+# unchanged, parse(payload) yields records, normalize(record, update_time) turns a record into the row commit()
+# takes (None skips it) and commit(connection, rows, update_time) stores the rows, returning the result
+class Source:
+    name = 'source'
+    # prefix of the ingest log lines
+    log_prefix = "Update Thread"
+
+    def fetch(self):
+        raise NotImplementedError
+
+    def parse(self, payload):
+        raise NotImplementedError
+
+    def normalize(self, record, update_time):
+        return record
+
+    def commit(self, connection, rows, update_time):
+        return commit_snapshot(connection, rows, update_time)
+
+    # the fetched payload was committed
+    def committed(self):
+        pass
+
+
+# the worldometers countries table, fetched with conditional GETs; with archive_dir every new page is saved there
+# (gzipped) for the replay source
+class WorldometersSource(Source):
+    name = 'worldometers'
+
+    def __init__(self, url=scrape_url, backend=None, archive_dir=None):
+        self.url = url
+        self.backend = backend
+        self.archive_dir = archive_dir
+        self.etag = None
+        self.last_modified = None
+        self.page_hash = None
+        # validators and hash of the last fetched page, kept once it is committed (a rejected page is fetched again)
+        self.fetched_etag = None
+        self.fetched_last_modified = None
+        self.fetched_hash = None
+
+    def fetch(self):
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        site_data = requests.get(self.url, headers=headers, timeout=60)
+        if site_data.status_code == 304:
+            return 'not_modified', None
+        site_data.raise_for_status()
+        self.fetched_etag = site_data.headers.get('ETag')
+        self.fetched_last_modified = site_data.headers.get('Last-Modified')
+        self.fetched_hash = hashlib.sha1(site_data.content).hexdigest()
+        if self.fetched_hash == self.page_hash:
+            # the committed page, under new validators
+            self.committed()
+            return 'unchanged', None
+        if self.archive_dir is not None:
+            archive_page(self.archive_dir, site_data.content)
+        return 'fetched', site_data.text
+
+    def parse(self, payload):
+        return parse_backends[self.backend or parse_backend](payload)
+
+    def normalize(self, cells, update_time):
+        if cells.__len__() <= 14:
+            return None
+        country = parse_string(parse_item_string(cells, 1))
+        if country.__len__() == 0 or country in skipped_countries:
+            return None
+        return CountryRow(
+            country,
+            format_count(parse_count(parse_item_string(cells, 2))),
+            format_count(parse_count(parse_item_string(cells, 4))),
+            format_count(parse_count(parse_item_string(cells, 6))),
+            format_count(parse_count(parse_item_string(cells, 12))),
+            format_count(parse_count(parse_item_string(cells, 9))),
+            format_count(parse_count(parse_item_string(cells, 8))),
+            format_count(parse_count(parse_item_string(cells, 14))),
+            update_time,
+            parse_item_string(cells, 1),
+        )
+
+    def committed(self):
+        self.etag = self.fetched_etag
+        self.last_modified = self.fetched_last_modified
+        self.page_hash = self.fetched_hash
+
+
+# saved worldometers pages (.html or .html.gz files, or directories of them such as an archive_dir) replayed in
+# name order, one page per fetch; once all are replayed fetch reports not_modified, or starts over with loop
+class ReplaySource(WorldometersSource):
+    name = 'replay'
+
+    def __init__(self, paths, backend=None, loop=False):
+        super().__init__(backend=backend)
+        self.paths = []
+        for path in paths:
+            self.paths += sorted(glob.glob(os.path.join(path, '*.html*'))) if os.path.isdir(path) else [path]
+        self.loop = loop
+        self.position = 0
+
+    def fetch(self):
+        if self.position >= self.paths.__len__():
+            if not self.loop or self.paths.__len__() == 0:
+                return 'not_modified', None
+            self.position = 0
+        path = self.paths[self.position]
+        self.position += 1
+        with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as page_file:
+            content = page_file.read()
+        self.fetched_hash = hashlib.sha1(content).hexdigest()
+        if self.fetched_hash == self.page_hash:
+            return 'unchanged', None
+        return 'fetched', content.decode('utf-8')
+
+
+# history backfill from a CSV file (header: country, date and the count fields) or a JSON file (a list of objects
+# with the same keys), optionally gzipped, streamed into the history table in one transaction
+class BulkSource(Source):
+    name = 'bulk'
+    log_prefix = "Backfill"
+
+    def __init__(self, path):
+        self.path = path
+        self.unknown = set()
+        self.bad_dates = set()
+
+    def fetch(self):
+        return 'fetched', self.path
+
+    def parse(self, payload):
+        with (gzip.open(payload, 'rt', encoding='utf-8', newline='') if payload.endswith('.gz') else
+              open(payload, encoding='utf-8', newline='')) as bulk_file:
+            if payload.endswith(('.json', '.json.gz')):
+                yield from json.load(bulk_file)
+            else:
+                yield from csv.DictReader(bulk_file)
+
+    # rows of unknown countries are skipped, like the scraper drops rows it can't use
+    def normalize(self, record, update_time):
+        country = resolve_country(str(record['country']))
+        if country is None:
+            if record['country'] not in self.unknown:
+                self.unknown.add(record['country'])
+                logger.error("Backfill: unknown country " + str(record['country']) + " in " + self.path + ", skipped")
+            return None
+        date = str(record['date'])[:10]
+        try:
+            datetime.strptime(date, "%Y-%m-%d")
+        except ValueError:
+            if date not in self.bad_dates:
+                self.bad_dates.add(date)
+                logger.error("Backfill: bad date " + str(record['date']) + " in " + self.path + " (not YYYY-MM-DD), "
+                             "skipped")
+            return None
+        return (country, date) + tuple(bulk_count(record.get(field)) for field in count_fields)
+
+    def commit(self, connection, rows, update_time):
+        stage_start = time.time()
+        counter = [0]
+
+        def counted():
+            for row in rows:
+                counter[0] += 1
+                yield row
+        with connection:
+            write_history_rows(connection, counted())
+        logger.info("Backfill: {0} history rows from {1} in {2:.2f}s".format(
+            counter[0], self.path, time.time() - stage_start))
+        return 'backfilled'
+
+
+# count of a bulk record: JSON numbers as they are (1700.0 included), text as the scraped cells
+def bulk_count(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    return parse_count(value)
+
+
+def archive_page(archive_dir, content):
     try:
-        site_data = requests.get("https://www.worldometers.info/coronavirus/?zarsrc=130#countries")
+        os.makedirs(archive_dir, exist_ok=True)
+        path = os.path.join(archive_dir, "worldometers-" + datetime.now().strftime("%Y%m%d-%H%M%S") + ".html.gz")
+        with gzip.open(path, 'wb') as archive_file:
+            archive_file.write(content)
+    except OSError as e:
+        logger.error("Archive: " + str(e))
+
+
+# parse, diff, validate, write and publish the rows of a full countries table
+def commit_snapshot(connection, rows, update_time):
+    stage_start = time.time()
+    rows = {row.country: row for row in rows}
+    parse_time = time.time() - stage_start
+    observe_metric('bot_scrape_seconds', parse_time, stage='parse')
+
+    stage_start = time.time()
+    current = snapshot
+    for key in current.rows.keys():
+        if key not in row_hashes:
+            row_hashes[key] = row_hash(current.rows[key])
+    changed = [key for key in rows.keys() if row_hash(rows[key]) != row_hashes.get(key)]
+    new_rows = dict(current.rows)
+    new_rows.update((key, rows[key]) for key in changed)
+    diff_time = time.time() - stage_start
+    observe_metric('bot_scrape_seconds', diff_time, stage='diff')
+
+    stage_start = time.time()
+    typed_rows = {key: (key,) + tuple(parse_count(rows[key][field]) for field in count_fields) +
+                  (rows[key].update_time, rows[key].country_name) for key in rows.keys()}
+    # the scraped rows themselves, the merged ones always look complete
+    if not validate_rows(rows):
+        return 'invalid'
+    with connection:
+        write_rows(connection, [typed_rows[key] for key in changed])
+        write_history(connection, typed_rows.values(), update_time[:10])
+    # a new version would invalidate the version keyed caches (keyboards, inline results) for nothing
+    if changed.__len__() > 0:
+        publish_snapshot(new_rows)
+    for key in changed:
+        row_hashes[key] = row_hash(rows[key])
+    write_time = time.time() - stage_start
+    observe_metric('bot_scrape_seconds', write_time, stage='write')
+    count_metric('bot_rows_changed_total', changed.__len__())
+    logger.info("Update Thread: {0}/{1} rows changed (parse {2:.2f}s, diff {3:.2f}s, write {4:.2f}s)".format(
+        changed.__len__(), rows.__len__(), parse_time, diff_time, write_time))
+    return 'updated' if changed.__len__() > 0 else 'unchanged'
+
+
+# run a source: fetch -> parse -> normalize -> commit, returns the result of the fetch or of the commit
+def ingest(source, connection):
+    stage_start = time.time()
+    result, payload = source.fetch()
+    fetch_time = time.time() - stage_start
+    observe_metric('bot_scrape_seconds', fetch_time, stage='fetch')
+    if result == 'fetched':
         update_time = str(datetime.now()).split(".")[0]
-        soup = BeautifulSoup(site_data.text, 'html.parser')
-        for data_item in soup.findAll('tr'):
-            _item_content = data_item.findAll('td')
-            if _item_content.__len__() > 7:
-                country = parse_string(parse_item_string(_item_content, 1))
-                total_case = parse_item_string(_item_content, 2)
-                total_death = parse_item_string(_item_content, 4)
-                total_recovery = parse_item_string(_item_content, 6)
-                active_case = parse_item_string(_item_content, 8)
-                critical_case = parse_item_string(_item_content, 9)
-                total_test = parse_item_string(_item_content, 12)
-                population = parse_item_string(_item_content, 14)
-
-                if country.__len__() != 0 and country != "Total:" and country != "-":
-                    data[country] = {
-                        'country': country,
-                        'total_case': total_case,
-                        'total_death': total_death,
-                        'total_recovery': total_recovery,
-                        'total_test': total_test,
-                        'critical_case': critical_case,
-                        'active_case': active_case,
-                        'population': population,
-                        'update_time': update_time,
-                        'country_name': parse_item_string(_item_content, 1),
-                    }
-
-        db_empty = False
-        try:
-            u_cursor.execute("select * from corona")
-            u_cursor.fetchall()
-            logger.info("Update Thread: Database not empty")
-        except Exception as e:
-            logger.error("Update Thread: " + str(e))
-            logger.info("Update Thread: Database doesn't exist")
-            logger.info("Update Thread: Setting up database")
-            setup_database(u_cursor, u_connection)
-            logger.info("Update Thread: Database setup")
-            db_empty = True
-
-        if db_empty:
-            logger.info("Update Thread: Inserting data to database")
+        normalized = (source.normalize(record, update_time) for record in source.parse(payload))
+        result = source.commit(connection, (row for row in normalized if row is not None), update_time)
+        if result != 'invalid':
+            source.committed()
+    count_metric('bot_scrapes_total', result=result, source=source.name)
+    logger.info("{0}: {1} {2} (fetch {3:.2f}s)".format(source.log_prefix, source.name, result, fetch_time))
+    return result
+
+
+def make_source(name):
+    if name == 'replay':
+        return ReplaySource(os.environ.get("replay-path", "fixtures").split(os.pathsep))
+    return WorldometersSource(archive_dir=source_archive_dir)
+
+
+# source of the scheduled updates: worldometers (default) or replay (of the replay-path files and directories)
+source_archive_dir = os.environ.get("source-archive-dir")
+ingest_source = make_source(os.environ.get("source", "worldometers"))
+
+
+# load history files (see BulkSource) into the database, each in one transaction
+def backfill(paths):
+    connection = get_connection()
+    setup_database(connection)
+    load_data()
+    rebuild_resolver()
+    for path in paths:
+        ingest(BulkSource(path), connection)
+
+
+# update the data from ingest_source, returns the result: updated, unchanged, not_modified, invalid or error
+def update_count(u_cursor, u_connection):
+    try:
+        result = ingest(ingest_source, u_connection)
+    except Exception as e:
+        count_metric('bot_scrapes_total', result='error', source=ingest_source.name)
+        logger.error("Network Error, Couldn't fetch data: " + str(e))
+        return 'error'
+    if result == 'updated':
+        prune_image_cache()
+        rebuild_resolver()
+        start_prerender()
+        if push_bot is not None:
+            enqueue_pushes(u_connection)
+    return result
+
+
+def load_schedule(connection):
+    global update_last_success, update_delay
+    with connection:
+        connection.execute("create table if not exists state (key text primary key, value)")
+    state = dict(connection.execute("select key, value from state where key in ('last_success', 'update_delay')"))
+    update_last_success = state.get('last_success')
+    update_delay = min(max(int(state.get('update_delay', update_delay)), update_min_delay), update_max_delay)
+
+
+def save_schedule(connection):
+    with connection:
+        connection.executemany("insert or replace into state (key, value) values (?,?)",
+                               [('last_success', update_last_success), ('update_delay', update_delay)])
+
+
+# seconds until the first update: what is left of the interval since the last success
+def first_update_delay():
+    if update_last_success is None:
+        return 0
+    return max(0.0, update_last_success + update_delay - time.time())
+
+
+# seconds until the next update after a result of update_count
+def schedule_next(result):
+    global update_delay, update_failures, update_last_success
+    if result in ('updated', 'unchanged', 'not_modified'):
+        update_failures = 0
+        update_last_success = time.time()
+        if result == 'updated':
+            update_delay = max(update_min_delay, update_delay // 2)
         else:
-            logger.info("Update Thread: Updating database content")
-
-        for key in data.keys():
-            if db_empty:
-                u_cursor.execute(
-                    "insert into corona (country, total_case, total_death, total_recovery, total_test,"
-                    "critical_case, active_case, population, update_time, country_name) values (?,?,?,?,?,?,?,?,?,?)",
-                    (data[key]['country'], data[key]['total_case'], data[key]['total_death'], data[key]['total_recovery'],
-                     data[key]['total_test'], data[key]['critical_case'], data[key]['active_case'], data[key]['population'],
-                     data[key]['update_time'], data[key]['country_name']))
-            else:
-                u_cursor.execute(
-                    "update corona set total_case=?, total_death=?, total_recovery=?, total_test=?, critical_case=?, "
-                    "active_case=?, population=?, update_time=? where country=?",
-                    (data[key]['total_case'], data[key]['total_death'], data[key]['total_recovery'], data[key]['total_test']
-                     , data[key]['critical_case'], data[key]['active_case'], data[key]['population'],
-                     data[key]['update_time'], key))
-        u_connection.commit()
-        image_cache.clear()
-    except:
-        logger.error("Network Error, Couldn't fetch data")
+            update_delay = min(update_max_delay, update_delay * 2)
+        delay = update_delay
+    else:
+        update_failures += 1
+        delay = min(update_max_delay, update_retry_delay * 2 ** (update_failures - 1))
+    return delay * random.uniform(1 - update_jitter, 1 + update_jitter)
+
+
+# sleep until the next update or an admin refresh
+def wait_for_update(delay):
+    global update_next_run
+    update_next_run = time.time() + delay
+    if refresh_event.wait(delay):
+        refresh_event.clear()
+        logger.info("Update Thread: refresh requested")
+
+
+# one scheduled update, returns the delay until the next one; any failure (a locked database in the post-update
+# steps or in save_schedule...) counts as an error, so the update loop keeps running with the retry backoff
+def run_update(connection):
+    set_trace(new_trace())
+    logger.info("Update Thread: update initialized")
+    try:
+        result = update_count(connection.cursor(), connection)
+        delay = schedule_next(result)
+        save_schedule(connection)
+    except Exception as e:
+        logger.exception(e)
+        result = 'error'
+        delay = schedule_next(result)
+    logger.info("Update Thread: update " + result + ", " + schedule_report(delay))
+    set_trace(None)
+    return delay
+
+
+def data_age():
+    return None if update_last_success is None else time.time() - update_last_success
+
+
+def schedule_report(delay=None):
+    if delay is None:
+        delay = max(0.0, update_next_run - time.time()) if update_next_run is not None else None
+    age = data_age()
+    return "data age {0}, next update in {1} (interval {2}, {3} failures)".format(
+        "unknown" if age is None else timedelta(seconds=int(age)),
+        "unknown" if delay is None else timedelta(seconds=int(delay)),
+        timedelta(seconds=update_delay), update_failures)
+
+
+# database setup and schedule of the update loop, returns the delay until the first update (the retry delay if
+# the setup failed)
+def start_schedule(connection):
+    try:
+        setup_database(connection)
+        load_schedule(connection)
+        return first_update_delay()
+    except Exception as e:
+        logger.exception(e)
+        return schedule_next('error')
 
 
 def count_update():
-    logger.info("Update Thread: Initializing database connection")
-    update_connection = sqlite3.connect('Corona.db')
-    logger.info("Update Thread: Database connection initialized")
-    update_cursor = update_connection.cursor()
-    logger.info("Update Thread: Database cursor initialized")
+    update_connection = get_connection()
+    delay = start_schedule(update_connection)
+    logger.info("Update Thread: first update in " + str(timedelta(seconds=int(delay))))
     while True:
-        logger.info("Update Thread: update initialized")
-        update_count(update_cursor, update_connection)
-        logger.info("Update Thread: update completed")
-        logger.info("Update Thread: thread sleeping")
-        time.sleep(update_delay)
-        logger.info("Update Thread: thread wakeup")
+        wait_for_update(delay)
+        delay = run_update(update_connection)
 
 
 def formatted_query_result(query, item):
@@ -206,21 +1045,9 @@ Update Date:        {8}
                        item['update_time'], )
 
 
-def id_generator(size=6, chars=string.ascii_uppercase + string.digits):
-    return ''.join(random.choice(chars) for _ in range(size))
-
-
-country_connection = None
-
-
 def fetch_image_1(query, item):
     background_image = "http://image.bedrubahru.com/images/corona_ (7).jpg"
-    try:
-        country_cursor = country_connection.cursor()
-        country_cursor.execute("SELECT link FROM country WHERE name = '" + item['country'] + "'")
-        flag = country_cursor.fetchall()[0][0]
-    except:
-        flag = "https://upload.wikimedia.org/wikipedia/commons/e/ef/International_Flag_of_Planet_Earth.svg"
+    flag = country_flags.get(item['country'], default_flag)[1]
 
     bot_name = "@CoronaCounter_bot"
 
@@ -362,91 +1189,420 @@ def fetch_image_1(query, item):
     return response.content
 
 
-def fetch_image(query, item):
-    __image = get_cached_image(query)
-    if __image is not None:
-        print("Image form cache")
-        return {"status": 200, 'source': 'cache', "data": __image}
-    try:
-        country_cursor = country_connection.cursor()
-        country_cursor.execute("SELECT flag_path FROM country WHERE name = '" + item['country'] + "'")
-        flag = country_cursor.fetchall()[0][0]
-    except:
-        flag = "/countries/International_flag.png"
-    try:
-        size = 2000, 1400
-        my_image = Image.open("image/background.jpg")
-        my_image.thumbnail(size, Image.ANTIALIAS)
-        title_font = ImageFont.truetype('fonts/Singika.ttf', 55)
-        sub_font = ImageFont.truetype('fonts/Singika.ttf', 45)
-        sud_font = ImageFont.truetype('fonts/Singika.ttf', 35)
-
-        country_name = query
-        tc_p = "Total case"
-        tc_v = item['total_case']
-        tt_p = "Total test"
-        tt_v = item['total_test']
-        td_p = "Total death"
-        td_v = item['total_death']
-        tr_p = "Total recovery"
-        tr_v = item['total_recovery']
-        ac_p = "Active Case"
-        ac_v = item['active_case']
-        po_p = "Population"
-        po_v = item['population']
-        cc_p = "Critical Case"
-        cc_v = item['critical_case']
-        ut_v = parse_date(item['update_time'])
-        bn_v = "@CoronaCounter_Bot"
-
-        item_hh = 480
-        level_mult = 100
-
-        item_ws = 150
-        item_we = 550
-
-        image_editable = ImageDraw.Draw(my_image)
-        image_editable.text((30, 310), country_name, (237, 230, 211), font=title_font)
-
-        image_editable.text((item_ws, item_hh + (0 * level_mult)), tt_p, (237, 230, 211), font=sub_font)
-        image_editable.text((item_we, item_hh + (0 * level_mult)), tt_v, (237, 230, 211), font=sub_font)
-
-        image_editable.text((item_ws, item_hh + (1 * level_mult)), tc_p, (237, 230, 211), font=sub_font)
-        image_editable.text((item_we, item_hh + (1 * level_mult)), tc_v, (237, 230, 211), font=sub_font)
-
-        image_editable.text((item_ws, item_hh + (2 * level_mult)), td_p, (237, 230, 211), font=sub_font)
-        image_editable.text((item_we, item_hh + (2 * level_mult)), td_v, (237, 230, 211), font=sub_font)
-
-        image_editable.text((item_ws, item_hh + (3 * level_mult)), tr_p, (237, 230, 211), font=sub_font)
-        image_editable.text((item_we, item_hh + (3 * level_mult)), tr_v, (237, 230, 211), font=sub_font)
-
-        image_editable.text((item_ws, item_hh + (4 * level_mult)), ac_p, (237, 230, 211), font=sub_font)
-        image_editable.text((item_we, item_hh + (4 * level_mult)), ac_v, (237, 230, 211), font=sub_font)
-
-        image_editable.text((item_ws, item_hh + (5 * level_mult)), cc_p, (237, 230, 211), font=sub_font)
-        image_editable.text((item_we, item_hh + (5 * level_mult)), cc_v, (237, 230, 211), font=sub_font)
-
-        image_editable.text((item_ws, item_hh + (6 * level_mult)), po_p, (237, 230, 211), font=sub_font)
-        image_editable.text((item_we, item_hh + (6 * level_mult)), po_v, (237, 230, 211), font=sub_font)
-
-        image_editable.text((30, item_hh + (8.2 * level_mult)), ut_v, (237, 230, 211), font=sud_font)
-        image_editable.text((30, item_hh + (8.7 * level_mult)), bn_v, (237, 230, 211), font=sud_font)
-
-        flag = Image.open(flag[1:])
-        # flag = ImageOps.expand(flag, border=1, fill='rgb(0,0,0)')
-        flag.thumbnail((300, 250), Image.ANTIALIAS)
-        mask_im = Image.new("L", flag.size, 0)
+# card template, in the coordinates of the large size: static text drawn once per size on the background (the
+# static layer), dynamic text slots filled from the row (update_time through parse_date) and the flag box
+card_color = (237, 230, 211)
+card_rows = (("Total test", 'total_test'), ("Total case", 'total_case'), ("Total death", 'total_death'),
+             ("Total recovery", 'total_recovery'), ("Active Case", 'active_case'),
+             ("Critical Case", 'critical_case'), ("Population", 'population'))
+card_layout = {
+    'static': [(150, 480 + i * 100, label, 45) for i, (label, field) in enumerate(card_rows)] +
+              [(30, 1350, "@CoronaCounter_Bot", 35)],
+    'slots': [(30, 310, 'country_name', 55)] +
+             [(550, 480 + i * 100, field, 45) for i, (label, field) in enumerate(card_rows)] +
+             [(30, 1300, 'update_time', 35)],
+    'flag': (315, 50, 300, 250),
+}
+
+# card variants: size name -> scale of the template, format name -> (PIL format, file extension, option set by
+# the quality, default quality, other save options). card-format is a format name with an optional quality, e.g.
+# webp:75 or jpeg:85; the quality of png is its zlib level (0-9) and the one of png8 its palette size (the card is
+# quantized, which suits its few flat colors)
+card_sizes = {'large': 1.0, 'medium': 0.75, 'small': 0.5}
+card_formats = {
+    'png': ('PNG', 'png', 'compress_level', 6, {}),
+    'png8': ('PNG', 'png', 'colors', 64, {}),
+    'webp': ('WEBP', 'webp', 'quality', 80, {'method': 4}),
+    'jpeg': ('JPEG', 'jpg', 'quality', 85, {'optimize': True}),
+}
+# valid qualities of each quality option
+card_quality_ranges = {'compress_level': (0, 9), 'colors': (2, 256), 'quality': (1, 100)}
+
+
+# (format name, quality) of a card-format, ValueError if it is unknown or its quality is out of range
+def parse_card_format(image_format):
+    name, _, quality = image_format.partition(':')
+    if name not in card_formats:
+        raise ValueError("Unknown card format: " + image_format)
+    option, default = card_formats[name][2:4]
+    if quality == "":
+        return name, default
+    low, high = card_quality_ranges[option]
+    if not quality.isdigit() or not low <= int(quality) <= high:
+        raise ValueError("Card format {0}: {1} must be {2} to {3}".format(image_format, option, low, high))
+    return name, int(quality)
+
+
+card_size = os.environ.get("card-size", "large")
+card_format = os.environ.get("card-format", "png")
+if card_size not in card_sizes:
+    raise ValueError("Unknown card size: " + card_size)
+parse_card_format(card_format)
+
+
+# template assets shared by every render: loaded once, flags kept in an LRU bounded by asset_flag_budget
+asset_lock = threading.Lock()
+asset_background = None
+asset_layers = {}
+asset_fonts = {}
+asset_masks = {}
+asset_flags = OrderedDict()
+asset_flag_budget = 64 * 1024 * 1024
+asset_flag_bytes = 0
+asset_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def image_bytes(_image):
+    return _image.size[0] * _image.size[1] * len(_image.getbands())
+
+
+def get_background():
+    global asset_background
+    with asset_lock:
+        if asset_background is None:
+            asset_stats['misses'] += 1
+            background = Image.open("image/background.jpg")
+            background.thumbnail((2000, 1400), Image.LANCZOS)
+            asset_background = background
+        else:
+            asset_stats['hits'] += 1
+        return asset_background
+
+
+def get_font(size):
+    with asset_lock:
+        font = asset_fonts.get(size)
+        if font is None:
+            asset_stats['misses'] += 1
+            font = ImageFont.truetype('fonts/Singika.ttf', size)
+            asset_fonts[size] = font
+        else:
+            asset_stats['hits'] += 1
+        return font
+
+
+# background with the static text of the template at a card size, rendered once per size
+def get_static_layer(size):
+    with asset_lock:
+        layer = asset_layers.get(size)
+        if layer is not None:
+            asset_stats['hits'] += 1
+            return layer
+    scale = card_sizes[size]
+    layer = get_background().copy()
+    if scale != 1.0:
+        layer = layer.resize((round(layer.size[0] * scale), round(layer.size[1] * scale)), Image.LANCZOS)
+    draw = ImageDraw.Draw(layer)
+    for x, y, text, font_size in card_layout['static']:
+        draw.text((x * scale, y * scale), text, card_color, font=get_font(round(font_size * scale)))
+    with asset_lock:
+        asset_stats['misses'] += 1
+        return asset_layers.setdefault(size, layer)
+
+
+# blurred paste mask, shared by every flag of the same size and scale
+def get_flag_mask(size, scale=1.0):
+    mask = asset_masks.get((size, scale))
+    if mask is None:
+        mask_im = Image.new("L", size, 0)
         draw = ImageDraw.Draw(mask_im)
-        draw.rectangle((0, 0, 300, 250), fill=255)
-        mask_im_blur = mask_im.filter(ImageFilter.GaussianBlur(10))
-        my_image.paste(flag, (315, 50), mask_im_blur)
-        random_name = 'out/' + id_generator(10) + '_' + str(int(time.time())) + '.png'
-        my_image.save(random_name)
-        return {"status": 200, 'source': 'img_create', "data": random_name}
+        draw.rectangle((0, 0, card_layout['flag'][2] * scale, card_layout['flag'][3] * scale), fill=255)
+        mask = asset_masks.setdefault((size, scale), mask_im.filter(ImageFilter.GaussianBlur(10 * scale)))
+    return mask
+
+
+# flag resized to the flag box at a scale and its blurred mask
+def get_flag(flag_path, scale=1.0):
+    global asset_flag_bytes
+    key = (flag_path, scale)
+    with asset_lock:
+        cached = asset_flags.get(key)
+        if cached is not None:
+            asset_stats['hits'] += 1
+            asset_flags.move_to_end(key)
+            return cached
+        asset_stats['misses'] += 1
+    # decoded outside the lock, so renders of other flags don't wait; a concurrent decode of the same flag keeps
+    # the first one published
+    with Image.open(flag_path[1:]) as flag_file:
+        flag = flag_file.convert("RGB")
+    flag.thumbnail((round(card_layout['flag'][2] * scale), round(card_layout['flag'][3] * scale)),
+                   Image.LANCZOS)
+    mask = get_flag_mask(flag.size, scale)
+    with asset_lock:
+        cached = asset_flags.get(key)
+        if cached is not None:
+            return cached
+        cached = (flag, mask)
+        asset_flags[key] = cached
+        asset_flag_bytes += image_bytes(flag)
+        while asset_flag_bytes > asset_flag_budget and asset_flags.__len__() > 1:
+            _, (evicted, _) = asset_flags.popitem(last=False)
+            asset_flag_bytes -= image_bytes(evicted)
+            asset_stats['evictions'] += 1
+        return cached
+
+
+def asset_report():
+    return "Assets: {0} hits, {1} misses, {2} evictions, {3} flags ({4:.1f} MB), {5} masks, {6} layers".format(
+        asset_stats['hits'], asset_stats['misses'], asset_stats['evictions'], asset_flags.__len__(),
+        asset_flag_bytes / (1024 * 1024), asset_masks.__len__(), asset_layers.__len__())
+
+
+# encode a card in a card-format (name[:quality])
+def encode_card(card, image_format):
+    name, quality = parse_card_format(image_format)
+    pil_format, extension, option, default, options = card_formats[name]
+    options = dict(options)
+    if option == 'colors':
+        card = card.quantize(colors=quality, method=Image.FASTOCTREE)
+    else:
+        options[option] = quality
+        if card.mode != "RGB":
+            card = card.convert("RGB")
+    buffer = io.BytesIO()
+    card.save(buffer, format=pil_format, **options)
+    return buffer.getvalue()
+
+
+# render the card of a country: the dynamic slots and the flag on a copy of the static layer, returns the encoded
+# bytes (None on failure)
+def render_card(item, size=None, image_format=None):
+    size = size or card_size
+    scale = card_sizes[size]
+    start = time.time()
+    try:
+        card = get_static_layer(size).copy()
+        draw = ImageDraw.Draw(card)
+        for x, y, field, font_size in card_layout['slots']:
+            text = parse_date(item[field]) if field == 'update_time' else item[field]
+            draw.text((x * scale, y * scale), text, card_color, font=get_font(round(font_size * scale)))
+        flag, mask = get_flag(get_flag_path(item['country']), scale)
+        card.paste(flag, (round(card_layout['flag'][0] * scale), round(card_layout['flag'][1] * scale)), mask)
+        image_format = image_format or card_format
+        encode_start = time.time()
+        content = encode_card(card, image_format)
+        encode_time = time.time() - encode_start
+        observe_metric('bot_encode_seconds', encode_time, format=image_format)
+        count_metric('bot_card_bytes_total', content.__len__(), format=image_format)
+        observe_metric('bot_render_seconds', time.time() - start)
+        logger.debug("Render: {0} {1} {2}, {3} bytes (encode {4:.3f}s, total {5:.3f}s)".format(
+            item['country'], size, image_format, content.__len__(), encode_time, time.time() - start))
+        return content
     except Exception as ex:
-        print(ex)
         logger.exception(ex)
+        return None
+
+
+# stored cards are per variant (size and format), the store can be shared by differently configured bots
+def card_store_path(key):
+    name = hashlib.sha1('|'.join((key[0], key[1], card_size, card_format)).encode('utf-8')).hexdigest()
+    return os.path.join(card_store_dir, name + '.' + card_formats[card_format.partition(':')[0]][1])
+
+
+# index of the stored cards (path -> size) in least recently used order, scanned once from disk
+def load_card_store():
+    global card_store_index, card_store_bytes
+    if card_store_index is None:
+        os.makedirs(card_store_dir, exist_ok=True)
+        entries = []
+        with os.scandir(card_store_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(('.png', '.webp', '.jpg')):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+        card_store_index = OrderedDict((path, size) for _, path, size in sorted(entries))
+        card_store_bytes = sum(card_store_index.values())
+    return card_store_index
+
+
+def card_store_get(key):
+    global card_store_bytes
+    if card_store_dir is None:
+        return None
+    path = card_store_path(key)
+    with card_store_lock:
+        try:
+            if path not in load_card_store():
+                return None
+            with open(path, 'rb') as card_file:
+                content = card_file.read()
+            os.utime(path)
+            card_store_index.move_to_end(path)
+            return content
+        except OSError:
+            card_store_bytes -= card_store_index.pop(path, 0)
+            return None
+
+
+# write a card to the disk store, evicting the least recently used cards above card_store_limit
+def card_store_put(key, content):
+    global card_store_bytes
+    if card_store_dir is None:
+        return
+    path = card_store_path(key)
+    with card_store_lock:
+        try:
+            load_card_store()
+            temp_path = path + '.tmp'
+            with open(temp_path, 'wb') as card_file:
+                card_file.write(content)
+            os.replace(temp_path, path)
+            card_store_bytes += len(content) - card_store_index.pop(path, 0)
+            card_store_index[path] = len(content)
+            while card_store_bytes > card_store_limit and card_store_index.__len__() > 1:
+                old_path, size = card_store_index.popitem(last=False)
+                card_store_bytes -= size
+                os.remove(old_path)
+        except OSError as e:
+            logger.error("Card store: " + str(e))
+
+
+# cached or freshly rendered card bytes of a country (None on failure, or if not cached and render is False)
+def get_card(item, render=True):
+    key = (item['country'], item['update_time'])
+    rendered = render_cache.get(key)
+    if rendered is not None:
+        count_metric('bot_cache_lookups_total', cache='render', result='hit')
+        return rendered
+    count_metric('bot_cache_lookups_total', cache='render', result='miss')
+    rendered = card_store_get(key)
+    if card_store_dir is not None:
+        count_metric('bot_cache_lookups_total', cache='card_store', result='miss' if rendered is None else 'hit')
+    if rendered is None:
+        if not render:
+            return None
+        rendered = render_card(item)
+        if rendered is None:
+            return None
+        card_store_put(key, rendered)
+    render_cache[key] = rendered
+    return rendered
+
+
+def fetch_image(query, item):
+    __image = get_cached_image((item['country'], item['update_time']))
+    if __image is not None:
+        logger.info("Card of " + item['country'] + " from file_id cache")
+        return {"status": 200, 'source': 'cache', "data": __image}
+    rendered = get_card(item)
+    if rendered is None:
         return {'status': 500, 'data': "None"}
+    return {"status": 200, 'source': 'img_create', "data": rendered}
+
+
+# start pre-rendering every card for the current data, superseding any running pre-render
+def start_prerender():
+    global render_generation
+    with render_lock:
+        render_generation += 1
+        generation = render_generation
+    threading.Thread(target=prerender_cards, args=(generation,), daemon=True).start()
+
+
+def prerender_card(generation, item):
+    if generation != render_generation:
+        return False
+    return get_card(item) is not None
+
+
+# render farm process setup (spawned, so no lock or connection is inherited from the bot's threads):
+# flag table and static layer loaded once
+def render_process_init():
+    load_flags()
+    get_static_layer(card_size)
+
+
+# render cards in worker processes, yielding (item, content) in order; content is None on failure or timeout.
+# At most one job per process is submitted at a time, so a job's timeout runs from its submission; after a
+# timeout the pool is replaced (the hung worker with it) and the other running jobs are submitted again.
+def render_farm(items, processes=None, timeout=None, generation=None):
+    context = multiprocessing.get_context('spawn')
+    processes = processes or render_processes or os.cpu_count()
+    timeout = timeout or render_job_timeout
+    items = list(items)
+    pool = context.Pool(processes, initializer=render_process_init)
+    running = []
+    position = 0
+    try:
+        while position < items.__len__() or running.__len__() > 0:
+            while position < items.__len__() and running.__len__() < processes:
+                item = items[position]
+                running.append((item, pool.apply_async(render_card, (item,)), time.time() + timeout))
+                position += 1
+            if generation is not None and generation != render_generation:
+                return
+            item, job, deadline = running.pop(0)
+            try:
+                content = job.get(max(0.0, deadline - time.time()))
+            except multiprocessing.TimeoutError:
+                logger.error("Render: " + item['country'] + " timed out, restarting the render processes")
+                content = None
+                pool.terminate()
+                pool.join()
+                pool = context.Pool(processes, initializer=render_process_init)
+                running = [(other, pool.apply_async(render_card, (other,)), time.time() + timeout)
+                           for other, _, _ in running]
+            yield item, content
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def prerender_processes(generation, items):
+    rendered = 0
+    pending = []
+    for item in items:
+        if generation != render_generation:
+            return rendered
+        if get_card(item, render=False) is not None:
+            rendered += 1
+        else:
+            pending.append(item)
+    for item, content in render_farm(pending, generation=generation):
+        if content is not None:
+            key = (item['country'], item['update_time'])
+            card_store_put(key, content)
+            render_cache[key] = content
+            rendered += 1
+    return rendered
+
+
+def prerender_threads(generation, items):
+    rendered = 0
+    with ThreadPoolExecutor(max_workers=render_workers) as executor:
+        futures = [executor.submit(prerender_card, generation, item) for item in items]
+        for future in as_completed(futures):
+            if generation != render_generation:
+                for f in futures:
+                    f.cancel()
+                return rendered
+            if future.result():
+                rendered += 1
+    return rendered
+
+
+# render all cards in a bounded worker pool, stops early if a newer refresh started
+def prerender_cards(generation):
+    current = snapshot
+    items = list(current.rows.values())
+    logger.info("Render: pre-rendering " + str(len(items)) + " cards")
+    start = time.time()
+    if render_processes > 0:
+        rendered = prerender_processes(generation, items)
+    else:
+        rendered = prerender_threads(generation, items)
+    if generation != render_generation:
+        logger.info("Render: newer refresh started, pre-render stopped after " + str(rendered) + " cards")
+        return rendered
+    elapsed = time.time() - start
+    for key in list(render_cache.keys()):
+        if key[0] not in current.rows or current.rows[key[0]].update_time != key[1]:
+            del render_cache[key]
+    logger.info("Render: pre-rendered {0}/{1} cards in {2:.2f}s ({3:.1f} cards/s)".format(
+        rendered, len(items), elapsed, rendered / elapsed if elapsed > 0 else 0))
+    logger.info("Render: " + asset_report())
+    return rendered
 
 
 def parse_date(s):
@@ -455,65 +1611,803 @@ def parse_date(s):
     return date_.strftime('%Y, %b %d')
 
 
+# country resolver: normalized name/alias -> data key, plus a trigram index for "did you mean" suggestions
+default_aliases = {
+    'united_states': 'usa', 'united_states_of_america': 'usa', 'us': 'usa', 'america': 'usa',
+    'britain': 'uk', 'great_britain': 'uk', 'england': 'uk', 'united_kingdom': 'uk',
+    'democratic_republic_of_congo': 'drc', 'democratic_republic_of_the_congo': 'drc', 'dr_congo': 'drc',
+    'south_korea': 's._korea', 'korea': 's._korea',
+    'united_arab_emirates': 'uae',
+    'central_african_republic': 'car',
+    'czech_republic': 'czechia',
+    "cote_d'ivoire": 'ivory_coast', "côte_d'ivoire": 'ivory_coast',
+    'swaziland': 'eswatini',
+    'burma': 'myanmar',
+    'macedonia': 'north_macedonia',
+    'east_timor': 'timor-leste',
+    'vatican': 'vatican_city', 'holy_see': 'vatican_city',
+    'cape_verde': 'cabo_verde',
+    'macau': 'macao',
+    'saint_vincent_and_the_grenadines': 'st._vincent_grenadines',
+    'saint_barthelemy': 'st._barth',
+}
+resolver_names = {}
+resolver_trigrams = {}
+resolver_prefixes = {}
+resolver_prefix_length = 20
+resolver_lock = threading.Lock()
+resolver_min_score = 0.4
+
+
+# prefixes of the name and of each of its words ("south_africa" -> s, so, ..., a, af, ...)
+def name_prefixes(name):
+    prefixes = set()
+    for start in [0] + [i + 1 for i, c in enumerate(name) if c == '_']:
+        word = name[start:start + resolver_prefix_length]
+        prefixes.update(word[:i] for i in range(1, word.__len__() + 1))
+    return prefixes
+
+
+def name_trigrams(name):
+    padded = '  ' + name.replace('_', ' ') + ' '
+    return {padded[i:i + 3] for i in range(padded.__len__() - 2)}
+
+
+# alias table (alias -> country), seeded with default_aliases on first use
+def load_aliases():
+    alias_connection = get_connection()
+    with alias_connection:
+        alias_connection.execute("create table if not exists alias (alias primary key, country)")
+        alias_connection.executemany("insert or ignore into alias (alias, country) values (?,?)",
+                                     default_aliases.items())
+    return {parse_string(alias): country for alias, country in
+            alias_connection.execute("select alias, country from alias")}
+
+
+# bring the resolver in line with data, only touching names that were added, removed or retargeted
+def rebuild_resolver():
+    try:
+        aliases = load_aliases()
+    except sqlite3.Error as e:
+        logger.error("Resolver: couldn't load aliases, " + str(e))
+        aliases = default_aliases
+    rows = snapshot.rows
+    names = {alias: country for alias, country in aliases.items() if country in rows}
+    names.update({key: key for key in rows.keys()})
+    with resolver_lock:
+        removed = [name for name in resolver_names.keys() if names.get(name) != resolver_names[name]]
+        for name in removed:
+            del resolver_names[name]
+            for index, tokens in ((resolver_trigrams, name_trigrams(name)), (resolver_prefixes, name_prefixes(name))):
+                for token in tokens:
+                    postings = index[token]
+                    postings.discard(name)
+                    if postings.__len__() == 0:
+                        del index[token]
+        added = [name for name in names.keys() if name not in resolver_names]
+        for name in added:
+            resolver_names[name] = names[name]
+            for trigram in name_trigrams(name):
+                resolver_trigrams.setdefault(trigram, set()).add(name)
+            for prefix in name_prefixes(name):
+                resolver_prefixes.setdefault(prefix, set()).add(name)
+    logger.info("Resolver: {0} names indexed ({1} added, {2} removed)".format(
+        resolver_names.__len__(), added.__len__(), removed.__len__()))
+
+
+# countries having a name or alias starting with the query (by word), names starting with it first,
+# falling back to fuzzy suggestions
+def search_countries(query, limit=10):
+    prefix = parse_string(query)[:resolver_prefix_length]
+    rows = snapshot.rows
+    with resolver_lock:
+        keys = {resolver_names[name] for name in resolver_prefixes.get(prefix, ())}
+    keys = sorted((key for key in keys if key in rows),
+                  key=lambda k: (not k.startswith(prefix), str(rows[k].country_name)))
+    return keys[:limit] if keys.__len__() > 0 else suggest_countries(query, limit)
+
+
+# data key of a country name or alias (None if unknown)
+def resolve_country(query):
+    return resolver_names.get(parse_string(query))
+
+
+# closest countries to a misspelled name, best first
+def suggest_countries(query, limit=3):
+    query_trigrams = name_trigrams(parse_string(query))
+    shared = {}
+    with resolver_lock:
+        for trigram in query_trigrams:
+            for name in resolver_trigrams.get(trigram, ()):
+                shared[name] = shared.get(name, 0) + 1
+        scored = {}
+        for name, count in shared.items():
+            score = 2.0 * count / (query_trigrams.__len__() + name_trigrams(name).__len__())
+            key = resolver_names[name]
+            if score >= resolver_min_score and score > scored.get(key, 0):
+                scored[key] = score
+    return sorted(scored.keys(), key=lambda k: -scored[k])[:limit]
+
+
 def data_query(query):
     try:
         main_query = query
-        found = False
-        query = query.title()
-        if query.lower().strip() == 'usa':
-            query = 'USA'
-        if query.lower().strip() == 'united states':
-            query = 'USA'
-        if query.lower().strip() == 'britain':
-            query = 'UK'
-        if query.lower().strip() == 'england':
-            query = 'UK'
-        if query.lower().strip() == 'uk':
-            query = 'UK'
-        if query.lower().strip() == 'democratic republic of congo':
-            query = 'DRC'
-        if query.lower().strip() == 'congo':
-            query = 'DRC'
-
-        sub_query = parse_string(query)
-
-        for key in data.keys():
-            if key == sub_query.lower():
-                item = data[key]
-                found = True
-                r = None
-                try:
-                    resp = fetch_image(main_query, item)
-                    logger.info(resp)
-                    if resp['status'] == '500':
-                        r = {"type": 'text', 'data': formatted_query_result(main_query, item)}
-                    else:
-                        logger.info("===================================================")
-                        r = {"type": 'image', 'source': resp['source'], 'data': resp['data'],
-                             'text': formatted_query_result(main_query, item)}
-                except Exception as s:
-                    r = {"type": 'text', 'data': formatted_query_result(main_query, item)}
-                return r
-        if not found:
+        rows = snapshot.rows
+        key = resolve_country(query)
+        if key is None:
             r = {"type": 'text', 'data': "\"" + main_query + "\" not found in list of countries!"}
+            suggestions = suggest_countries(query)
+            if suggestions.__len__() > 0:
+                r['data'] += "\nDid you mean: " + ", ".join(rows[k].country_name for k in suggestions) + "?"
             return r
+        item = rows[key]
+        try:
+            resp = fetch_image(main_query, item)
+            logger.info("Image status: " + str(resp['status']) + ", source: " + str(resp.get('source')))
+            if resp['status'] == 500:
+                r = {"type": 'text', 'data': formatted_query_result(main_query, item)}
+            else:
+                logger.info("===================================================")
+                r = {"type": 'image', 'source': resp['source'], 'data': resp['data'],
+                     'key': (item['country'], item['update_time']),
+                     'text': formatted_query_result(main_query, item)}
+        except Exception as s:
+            r = {"type": 'text', 'data': formatted_query_result(main_query, item)}
+        return r
     except Exception as v:
-        print(v.with_traceback())
+        logger.exception(v)
         r = {"type": 'text', 'data': "There was an error!"}
         return r
 
 
+# trend charts, cached per (country, window, last date)
+trend_windows = (7, 30, 90)
+trend_default_window = 30
+trend_average_days = 7
+trend_cache = OrderedDict()
+trend_cache_size = 256
+trend_lock = threading.Lock()
+
+
+# daily deltas of a cumulative series (the first value has no delta)
+def series_deltas(values):
+    return [max(current - previous, 0) for previous, current in zip(values, values[1:])]
+
+
+# trailing rolling average, computed from prefix sums in one pass
+def rolling_average(values, days):
+    sums = [0] + list(accumulate(values))
+    return [(sums[i + 1] - sums[max(i + 1 - days, 0)]) / min(i + 1, days) for i in range(values.__len__())]
+
+
+# total cases of the window plus one prior day, forward filling missing values
+def trend_series(history):
+    dates = []
+    totals = []
+    for row in history:
+        value = row[1] if row[1] is not None else (totals[-1] if totals.__len__() > 0 else None)
+        if value is not None:
+            dates.append(row[0])
+            totals.append(value)
+    return dates, totals
+
+
+def render_trend(item, window, dates, totals):
+    deltas = series_deltas(totals)
+    averages = rolling_average(deltas, trend_average_days)
+    dates = dates[1:]
+    my_image = get_background().copy()
+    image_editable = ImageDraw.Draw(my_image)
+    width, height = my_image.size
+    color = (237, 230, 211)
+    image_editable.text((30, 50), item['country_name'], color, font=get_font(55))
+    image_editable.text((30, 130), "New cases, last " + str(window) + " days", color, font=get_font(45))
+    image_editable.text((30, 200), "Latest: {0}   {1}-day average: {2}".format(
+        format_count(deltas[-1]), trend_average_days, format_count(int(round(averages[-1])))), color,
+        font=get_font(35))
+
+    left, right, top, bottom = 150, width - 80, 330, height - 250
+    peak = max(max(deltas), 1)
+    step = (right - left) / deltas.__len__()
+    for i, delta in enumerate(deltas):
+        x = left + i * step
+        y = bottom - (bottom - top) * delta / peak
+        image_editable.rectangle((x + step * 0.15, y, x + step * 0.85, bottom), fill=(110, 105, 95))
+    points = [(left + (i + 0.5) * step, bottom - (bottom - top) * average / peak)
+              for i, average in enumerate(averages)]
+    if points.__len__() > 1:
+        image_editable.line(points, fill=color, width=6)
+    image_editable.line((left, bottom, right, bottom), fill=color, width=2)
+    image_editable.text((30, top), format_count(peak), color, font=get_font(35))
+    image_editable.text((left, bottom + 20), parse_date(dates[0] + " 00:00:00"), color, font=get_font(35))
+    last_date = parse_date(dates[-1] + " 00:00:00")
+    image_editable.text((right - image_editable.textlength(last_date, font=get_font(35)), bottom + 20),
+                        last_date, color, font=get_font(35))
+    image_editable.text((30, height - 100), "@CoronaCounter_Bot", color, font=get_font(35))
+    buffer = io.BytesIO()
+    my_image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+# trend chart bytes of a country, None if there isn't enough history
+# the window ends on the latest history date of the country, not on its update_time: a row the scrapes don't
+# change keeps its update_time while the history still gets a row every day
+def trend_chart(t_connection, item, window):
+    until = t_connection.execute("select max(date) from history where country=?", (item['country'],)).fetchone()[0]
+    if until is None:
+        return None
+    since = (datetime.strptime(until, "%Y-%m-%d") - timedelta(days=window)).strftime("%Y-%m-%d")
+    dates, totals = trend_series(load_history(t_connection, item['country'], since, until))
+    if dates.__len__() < 2:
+        return None
+    key = (item['country'], window, dates[-1])
+    with trend_lock:
+        chart = trend_cache.get(key)
+        if chart is not None:
+            trend_cache.move_to_end(key)
+            return chart
+    chart = render_trend(item, window, dates, totals)
+    with trend_lock:
+        trend_cache[key] = chart
+        while trend_cache.__len__() > trend_cache_size:
+            trend_cache.popitem(last=False)
+    return chart
+
+
+# render executor: handlers queue renders here instead of rendering on the dispatcher threads; the replies
+# (uploads included) run on the reply executor, so network I/O never holds a render worker
+render_queue_size = 64
+render_queue_workers = 4
+reply_workers = 8
+reply_executor = ThreadPoolExecutor(max_workers=reply_workers, thread_name_prefix="reply")
+render_queue = queue.Queue(maxsize=render_queue_size)
+render_inflight = {}
+render_inflight_lock = threading.Lock()
+render_queue_stats = {'queued': 0, 'merged': 0, 'rejected': 0, 'completed': 0, 'wait_time': 0.0,
+                      'render_time': 0.0}
+render_report_every = 100
+
+
+# queue job() and pass its result to reply(result) on the reply executor; identical in-flight jobs (same key)
+# share one run, each requester keeps its own reply
+def submit_job(key, job, reply):
+    with render_inflight_lock:
+        waiters = render_inflight.get(key)
+        if waiters is not None:
+            waiters.append((current_trace(), reply))
+            render_queue_stats['merged'] += 1
+            return True
+        render_inflight[key] = [(current_trace(), reply)]
+        try:
+            render_queue.put_nowait((key, job, time.time(), current_trace()))
+        except queue.Full:
+            del render_inflight[key]
+            render_queue_stats['rejected'] += 1
+            return False
+        render_queue_stats['queued'] += 1
+    return True
+
+
+def render_queue_report():
+    completed = max(render_queue_stats['completed'], 1)
+    return "Render queue: depth {0}, {1} queued, {2} merged, {3} rejected, avg wait {4:.3f}s, avg render " \
+           "{5:.3f}s".format(render_queue.qsize(), render_queue_stats['queued'], render_queue_stats['merged'],
+                             render_queue_stats['rejected'], render_queue_stats['wait_time'] / completed,
+                             render_queue_stats['render_time'] / completed)
+
+
+def render_worker():
+    while True:
+        key, job, queued_at, trace_id = render_queue.get()
+        set_trace(trace_id)
+        started = time.time()
+        try:
+            result = job()
+        except Exception as e:
+            logger.exception(e)
+            result = {"type": 'text', 'data': "There was an error!"}
+        finished = time.time()
+        observe_metric('bot_render_queue_wait_seconds', started - queued_at)
+        with render_inflight_lock:
+            waiters = render_inflight.pop(key)
+            render_queue_stats['completed'] += 1
+            render_queue_stats['wait_time'] += started - queued_at
+            render_queue_stats['render_time'] += finished - started
+            completed = render_queue_stats['completed']
+        reply_executor.submit(deliver_replies, waiters, result)
+        set_trace(None)
+        if completed % render_report_every == 0:
+            logger.info(render_queue_report())
+
+
+# replies of the requesters of one job, in order: the first one uploads a card, the others find its file_id
+def deliver_replies(waiters, result):
+    for trace_id, reply in waiters:
+        set_trace(trace_id)
+        try:
+            reply(result)
+        except Exception as e:
+            logger.exception(e)
+    set_trace(None)
+
+
+def start_render_executor():
+    for i in range(render_queue_workers):
+        threading.Thread(target=render_worker, name="render-" + str(i), daemon=True).start()
+
+
+# card answerable without a render: its file_id or its bytes are cached
+def card_cached(item):
+    key = (item['country'], item['update_time'])
+    return key in image_cache or key in render_cache
+
+
+# answer a country query: unknown countries and cached cards right away, renders through the render executor
+# (text when the queue is full); each requester's answer is built from its own query once the card is rendered
+def dispatch_query(query, reply):
+    key = resolve_country(query)
+    if key is None or card_cached(snapshot.rows[key]):
+        reply(data_query(query))
+        return
+    item = snapshot.rows[key]
+
+    def rendered(card):
+        reply(data_query(query) if isinstance(card, bytes) else
+              {"type": 'text', 'data': formatted_query_result(query, item)})
+    if not submit_job(('card', key), lambda: get_card(item), rendered):
+        reply({"type": 'text', 'data': formatted_query_result(query, item)})
+
+
+# /list keyboards, built once per snapshot: the alphabet plus paginated country keyboards per letter.
+# callback_data is namespaced (letters, letter:X, page:X:n, country:key) so letters never collide with countries.
+keyboard_page_size = 20
+keyboard_index = None
+keyboard_lock = threading.Lock()
+
+
+def build_keyboards(current):
+    letters = OrderedDict()
+    for name, key in sorted((str(row.country_name), key) for key, row in current.rows.items()):
+        letters.setdefault(name[0], []).append((name, key))
+    alphabet = [InlineKeyboardButton(letter, callback_data='letter:' + letter) for letter in letters.keys()]
+    pages = {}
+    for letter, countries in letters.items():
+        count = (countries.__len__() + keyboard_page_size - 1) // keyboard_page_size
+        pages[letter] = []
+        for page in range(count):
+            buttons = [InlineKeyboardButton(name, callback_data='country:' + key) for name, key in
+                       countries[page * keyboard_page_size:(page + 1) * keyboard_page_size]]
+            keyboard = [buttons[i:i + 2] for i in range(0, buttons.__len__(), 2)]
+            navigation = []
+            if page > 0:
+                navigation.append(InlineKeyboardButton("Prev", callback_data='page:' + letter + ':' + str(page - 1)))
+            navigation.append(InlineKeyboardButton("Letters", callback_data='letters'))
+            if page < count - 1:
+                navigation.append(InlineKeyboardButton("Next", callback_data='page:' + letter + ':' + str(page + 1)))
+            keyboard.append(navigation)
+            pages[letter].append(InlineKeyboardMarkup(keyboard))
+    return {'version': current.version,
+            'alphabet': InlineKeyboardMarkup([alphabet[i:i + 5] for i in range(0, alphabet.__len__(), 5)]),
+            'letters': pages}
+
+
+def get_keyboards():
+    global keyboard_index
+    current = snapshot
+    index = keyboard_index
+    if index is None or index['version'] != current.version:
+        with keyboard_lock:
+            if keyboard_index is None or keyboard_index['version'] != current.version:
+                keyboard_index = build_keyboards(current)
+            index = keyboard_index
+    return index
+
+
+# keyboard of a letter page (None for an unknown letter, out of range pages are clamped)
+def letter_keyboard(letter, page=0):
+    pages = get_keyboards()['letters'].get(letter)
+    if pages is None:
+        return None
+    return pages[min(max(page, 0), pages.__len__() - 1)]
+
+
+# inline mode: results per (snapshot version, query), kept inline_cache_ttl seconds
+inline_cache = OrderedDict()
+inline_cache_ttl = 300
+inline_cache_size = 1024
+inline_cache_lock = threading.Lock()
+inline_result_limit = 10
+# seconds Telegram may cache an answer on its side
+inline_cache_time = 300
+
+
+# forget the cached answers listing a country, so they pick up its newly uploaded card
+def drop_inline_results(country):
+    with inline_cache_lock:
+        for key in [key for key, (expires, results) in inline_cache.items()
+                    if any(result.id == country for result in results)]:
+            del inline_cache[key]
+
+
+def inline_results(query):
+    current = snapshot
+    key = (current.version, parse_string(query))
+    now = time.time()
+    with inline_cache_lock:
+        cached = inline_cache.get(key)
+        if cached is not None and cached[0] > now:
+            inline_cache.move_to_end(key)
+            return cached[1]
+    results = []
+    for country in search_countries(query, inline_result_limit):
+        row = current.rows[country]
+        file_id = get_cached_image((row.country, row.update_time))
+        if file_id is not None:
+            results.append(InlineQueryResultCachedPhoto(
+                id=country, photo_file_id=file_id, title=row.country_name, caption=row.country_name))
+        else:
+            results.append(InlineQueryResultArticle(
+                id=country,
+                title=row.country_name,
+                description="Total case: {0}, Total death: {1}".format(row.total_case, row.total_death),
+                input_message_content=InputTextMessageContent(formatted_query_result(row.country_name, row)),
+            ))
+    with inline_cache_lock:
+        inline_cache[key] = (now + inline_cache_ttl, results)
+        while inline_cache.__len__() > inline_cache_size:
+            inline_cache.popitem(last=False)
+    return results
+
+
+# /top and /compare answers: monospace tables (HTML <pre>) read from the snapshot rankings
+top_default = 10
+top_max = 50
+compare_max = 5
+compare_width = 14
+
+
+# metric name of user input ("cases", "Deaths per million", "test_per_1m"...), None if unknown
+def rank_metric(name):
+    base, per, suffix = parse_string(name).partition('_per_')
+    if per and suffix not in per_million_suffixes:
+        return None
+    base = metric_aliases.get(base, base)
+    metric = base + '_per_million' if per else base
+    return metric if metric in metric_labels else None
+
+
+def format_metric(value):
+    if value is None:
+        return "-"
+    return "{0:,.1f}".format(value) if isinstance(value, float) else "{0:,}".format(value)
+
+
+def top_table(current, metric, count):
+    rankings = current.rankings
+    lines = ["Top {0} by {1}".format(count, metric_labels[metric])]
+    for rank, key in enumerate(rankings['order'][metric][:count], 1):
+        name = str(current.rows[key].country_name)[:compare_width + 6]
+        lines.append("{0:>2} {1:<20} {2:>15}".format(rank, name, format_metric(rankings['values'][key][metric])))
+    return "<pre>" + escape_html("\n".join(lines)) + "</pre>"
+
+
+def compare_table(current, keys):
+    values = current.rankings['values']
+    names = [str(current.rows[key].country_name)[:compare_width] for key in keys]
+    lines = [" " * 16 + "".join("{0:>{1}}".format(name, compare_width + 1) for name in names)]
+    for metric, label in metric_labels.items():
+        lines.append("{0:<16}".format(label) + "".join(
+            "{0:>{1}}".format(format_metric(values[key].get(metric)), compare_width + 1) for key in keys))
+    return "<pre>" + escape_html("\n".join(lines)) + "</pre>"
+
+
+# daily push: /subscribe stores (chat, country) pairs, each update that changed rows queues the subscribers of
+# the changed countries in push_queue (persistent, so pending pushes and retries survive restarts) and the push
+# worker drains it country by country: the card is uploaded once and everyone else gets its file_id. Sends go
+# through token buckets below Telegram's limits (about 30 messages/s overall, 1/s per chat, 20/min per group).
+push_bot = None
+push_event = threading.Event()
+push_workers = 8
+push_rate = 25
+push_chat_rate = 1.0
+push_group_rate = 20 / 60.0
+push_retry_delay = 60
+push_max_attempts = 5
+subscribe_max = 10
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    # take a token, returns the seconds to wait first (0 if one was available)
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        wait = self.take()
+        if wait > 0:
+            time.sleep(wait)
+
+    # no tokens for the next seconds (after a 429)
+    def pause(self, seconds):
+        with self.lock:
+            self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+
+push_bucket = TokenBucket(push_rate, push_rate)
+push_chat_buckets = {}
+push_chat_lock = threading.Lock()
+
+
+def chat_bucket(chat_id):
+    with push_chat_lock:
+        bucket = push_chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = push_chat_buckets[chat_id] = TokenBucket(push_chat_rate if chat_id > 0 else push_group_rate)
+        return bucket
+
+
+def setup_push(connection):
+    with connection:
+        connection.execute("create table if not exists subscription (chat_id integer not null, country text not null, "
+                           "update_time text, primary key (chat_id, country)) without rowid")
+        connection.execute("create index if not exists subscription_country on subscription (country)")
+        connection.execute("create table if not exists push_queue (chat_id integer not null, country text not null, "
+                           "attempts integer, next_attempt real, primary key (chat_id, country)) without rowid")
+
+
+# queue the subscribers of countries whose update_time differs from the one they last received
+def enqueue_pushes(connection):
+    rows = snapshot.rows
+    countries = [country for (country,) in connection.execute("select distinct country from subscription")]
+    now = time.time()
+    with connection:
+        connection.executemany(
+            "insert or ignore into push_queue (chat_id, country, attempts, next_attempt) select chat_id, country, 0, ? "
+            "from subscription where country=? and (update_time is null or update_time!=?)",
+            [(now, country, rows[country].update_time) for country in countries if country in rows])
+    push_event.set()
+
+
+# send one push, returns the outcome: (sent, message), (gone, None), (migrated, new chat id), (retry, delay)
+# or (failed, None)
+def send_push(chat_id, photo, caption):
+    chat_bucket(chat_id).acquire()
+    push_bucket.acquire()
+    try:
+        return 'sent', push_bot.send_photo(chat_id, photo, caption=caption)
+    except RetryAfter as e:
+        push_bucket.pause(e.retry_after)
+        return 'retry', e.retry_after
+    except ChatMigrated as e:
+        return 'migrated', e.new_chat_id
+    except Unauthorized:
+        return 'gone', None
+    except BadRequest as e:
+        return ('gone', None) if 'chat not found' in str(e).lower() else ('failed', None)
+    except NetworkError:
+        return 'retry', None
+
+
+# store the outcomes of the pushes of a country: (chat_id, attempts, (outcome, value)) as returned by send_push
+def record_pushes(connection, country, update_time, results):
+    now = time.time()
+    with connection:
+        for chat_id, attempts, (outcome, value) in results:
+            count_metric('bot_pushes_total', result=outcome)
+            if outcome == 'sent':
+                connection.execute("delete from push_queue where chat_id=? and country=?", (chat_id, country))
+                connection.execute("update subscription set update_time=? where chat_id=? and country=?",
+                                   (update_time, chat_id, country))
+            elif outcome == 'gone':
+                connection.execute("delete from subscription where chat_id=?", (chat_id,))
+                connection.execute("delete from push_queue where chat_id=?", (chat_id,))
+            elif outcome == 'migrated':
+                connection.execute("update or replace subscription set chat_id=? where chat_id=?", (value, chat_id))
+                connection.execute("update or replace push_queue set chat_id=?, next_attempt=? where chat_id=?",
+                                   (value, now, chat_id))
+            elif outcome == 'retry' and value is not None:
+                # 429: wait as told, it doesn't count as an attempt
+                connection.execute("update push_queue set next_attempt=? where chat_id=? and country=?",
+                                   (now + value, chat_id, country))
+            elif attempts + 1 < push_max_attempts:
+                connection.execute("update push_queue set attempts=?, next_attempt=? where chat_id=? and country=?",
+                                   (attempts + 1, now + push_retry_delay * 2 ** attempts, chat_id, country))
+            else:
+                connection.execute("delete from push_queue where chat_id=? and country=?", (chat_id, country))
+
+
+# send the due pushes, returns the seconds until the next retry (None if the queue is empty)
+def drain_push_queue(connection, executor):
+    due = OrderedDict()
+    for chat_id, country, attempts in connection.execute(
+            "select chat_id, country, attempts from push_queue where next_attempt<=? order by country",
+            (time.time(),)):
+        due.setdefault(country, []).append((chat_id, attempts))
+    current = snapshot
+    for country, chats in due.items():
+        item = current.rows.get(country)
+        if item is None:
+            with connection:
+                connection.execute("delete from push_queue where country=?", (country,))
+            continue
+        key = (item['country'], item['update_time'])
+        caption = "Update: " + item['country_name'] + "\n/unsubscribe " + item['country_name'] + " to stop"
+        results = []
+        file_id = get_cached_image(key)
+        if file_id is None:
+            # the card is uploaded once, everyone else gets its file_id
+            card = get_card(item)
+            while file_id is None and card is not None and chats.__len__() > 0:
+                chat_id, attempts = chats.pop(0)
+                start = time.time()
+                outcome = send_push(chat_id, io.BytesIO(card), caption)
+                observe_metric('bot_upload_seconds', time.time() - start)
+                if outcome[0] == 'sent':
+                    cache_image(key, outcome[1])
+                    file_id = image_cache.get(key)
+                results.append((chat_id, attempts, outcome))
+        if file_id is None:
+            results += [(chat_id, attempts, ('failed', None)) for chat_id, attempts in chats]
+        else:
+            outcomes = executor.map(lambda chat: send_push(chat[0], file_id, caption), chats)
+            results += [(chat_id, attempts, outcome) for (chat_id, attempts), outcome in zip(chats, outcomes)]
+        record_pushes(connection, country, item['update_time'], results)
+        logger.info("Push: {0} sent to {1}/{2} chats".format(
+            country, sum(1 for result in results if result[2][0] == 'sent'), results.__len__()))
+    with push_chat_lock:
+        push_chat_buckets.clear()
+    following = connection.execute("select min(next_attempt) from push_queue").fetchone()[0]
+    return None if following is None else max(0.0, following - time.time())
+
+
+def push_worker():
+    connection = get_connection()
+    executor = ThreadPoolExecutor(max_workers=push_workers, thread_name_prefix="push-send")
+    while True:
+        try:
+            delay = drain_push_queue(connection, executor)
+        except Exception as e:
+            logger.exception(e)
+            delay = push_retry_delay
+        push_event.wait(delay)
+        push_event.clear()
+
+
+def start_push(bot):
+    global push_bot
+    push_bot = bot
+    setup_push(get_connection())
+    threading.Thread(target=push_worker, name="push", daemon=True).start()
+
+
 # Enable logging
 # logging.basicConfig(filename='Log_po.txt',
 #                     filemode='a',
 #                     format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
 #                     datefmt='%H:%M:%S',
 #                     level=logging.DEBUG)
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s', level=logging.INFO)
+record_factory = logging.getLogRecordFactory()
+
+
+def trace_record_factory(*args, **kwargs):
+    record = record_factory(*args, **kwargs)
+    record.trace_id = current_trace() or '-'
+    return record
+
+
+logging.setLogRecordFactory(trace_record_factory)
 
 logger = logging.getLogger(__name__)
 
 
+# handler wrapper: counts and times each update, which is handled under a new trace id; handlers that leave the
+# reply to the render queue (deferred) record the first response where it is sent instead of on return
+def instrumented(name, handler, deferred=False):
+    def run(update, context):
+        set_trace(new_trace())
+        count_metric('bot_requests_total', handler=name)
+        start = time.time()
+        try:
+            return handler(update, context)
+        finally:
+            observe_metric('bot_handler_seconds', time.time() - start, handler=name)
+            if not deferred:
+                first_response()
+            set_trace(None)
+    return run
+
+
+# startup report: seconds from the process start to imports, serving and first_response
+startup_stages = OrderedDict([('imports', startup_imported - startup_started)])
+startup_lock = threading.Lock()
+
+
+def startup_stage(stage):
+    startup_stages[stage] = time.time() - startup_started
+    logger.info("Startup: " + ", ".join("{0} {1:.2f}s".format(name, value) for name, value in startup_stages.items()))
+
+
+# called once a reply was sent, from the handler or from a reply worker
+def first_response():
+    with startup_lock:
+        if 'first_response' not in startup_stages:
+            startup_stage('first_response')
+
+
+# caches the first requests would otherwise fill: the deferred modules, the card static layer and fonts and the
+# /list keyboards; run in the background once the bot is serving
+def warm_caches():
+    start = time.time()
+    try:
+        for module in (requests, Image, ImageFont, ImageDraw, ImageFilter):
+            module._import()
+        if parse_backend == 'soup':
+            bs4._import()
+        get_static_layer(card_size)
+        for x, y, field, font_size in card_layout['slots']:
+            get_font(round(font_size * card_sizes[card_size]))
+        get_keyboards()
+        logger.info("Startup: caches warmed in {0:.2f}s".format(time.time() - start))
+    except Exception as e:
+        logger.exception(e)
+
+
+def start_warm_caches():
+    threading.Thread(target=warm_caches, name="warm", daemon=True).start()
+
+
+def is_admin(update):
+    return update.effective_user is not None and update.effective_user.id in admin_ids
+
+
+# Telegram's limit on the length of a message text
+message_max_length = 4096
+
+
+# parts of a long text that each fit in a message, split at line ends (long lines are cut)
+def split_message(text, limit=message_max_length):
+    parts = []
+    part = ""
+    for line in text.split("\n"):
+        while line.__len__() > limit:
+            if part != "":
+                parts.append(part)
+                part = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        if part != "" and part.__len__() + 1 + line.__len__() > limit:
+            parts.append(part)
+            part = line
+        else:
+            part = line if part == "" else part + "\n" + line
+    if part != "":
+        parts.append(part)
+    return parts
+
+
+def stats_text():
+    counters, histograms = collect_metrics()
+    lines = []
+    for (name, labels), value in sorted(counters.items()):
+        lines.append(name + label_text(labels) + " " + str(value))
+    for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+        lines.append("{0}{1} {2} x {3:.3f}s avg".format(name, label_text(labels), count, total / count))
+    lines += ["Schedule: " + schedule_report(), image_cache_report(), asset_report(), render_queue_report()]
+    return "\n".join(lines)
+
+
 # Define a few command handlers. These usually take the two arguments update and
 # context.
 def start(update: Update, context: CallbackContext) -> None:
@@ -526,33 +2420,7 @@ def start(update: Update, context: CallbackContext) -> None:
 
 
 def countries_list(update: Update, context: CallbackContext) -> None:
-    global country_connection
-    if country_connection is None:
-        country_connection = sqlite3.connect('Corona.db')
-
-    c_cursor = country_connection.cursor()
-    res = c_cursor.execute("SELECT country, country_name FROM corona ORDER BY country_name")
-    f = []
-    o = []
-    s = []
-    for item in res.fetchall():
-        ll = str(item[1])[0]
-        if ll is None:
-            continue
-        if not s.__contains__(ll):
-            s.append(ll)
-            o.append(InlineKeyboardButton(ll, callback_data=ll))
-            if o.__len__() == 5:
-                f.append(o)
-                o = []
-
-    # f.append([InlineKeyboardButton("Prev", callback_data='prev')])
-    # f.append([InlineKeyboardButton("Next", callback_data='next')])
-
-    keyboard = f
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text('Please choose country:', reply_markup=reply_markup)
+    update.message.reply_text('Please choose country:', reply_markup=get_keyboards()['alphabet'])
 
 
 def button(update: Update, context: CallbackContext) -> None:
@@ -562,148 +2430,363 @@ def button(update: Update, context: CallbackContext) -> None:
     # CallbackQueries need to be answered, even if no notification to the user is needed
     # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
     query.answer()
-    if query.data != "next" or query.data != "prev":
-        if query.data.__len__() == 1:
-            global country_connection
-            if country_connection is None:
-                country_connection = sqlite3.connect('Corona.db')
-
-            c_cursor = country_connection.cursor()
-            mm = query.data + '%'
-            sql_q = "SELECT country, country_name FROM corona WHERE country_name LIKE ? ORDER BY country_name"
-            res = c_cursor.execute(sql_q, (mm,))
-            f = []
-            o = []
-            for item in res.fetchall():
-                ll = str(item[1])
-                o.append(InlineKeyboardButton(ll, callback_data=ll))
-                if o.__len__() == 2:
-                    f.append(o)
-                    o = []
-
-            # f.append([InlineKeyboardButton("Prev", callback_data='prev')])
-            # f.append([InlineKeyboardButton("Next", callback_data='next')])
-
-            keyboard = f
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            query.edit_message_text(text='Please choose country:', reply_markup=reply_markup)
-        else:
-            result = data_query(query.data)
+    action, _, value = query.data.partition(':')
+    if action not in ('letters', 'letter', 'page', 'country'):
+        # keyboards sent before callback_data was namespaced: a letter or a country name
+        action, value = ('letter', query.data) if query.data.__len__() == 1 else ('country', query.data)
+
+    if action == 'letters':
+        query.edit_message_text(text='Please choose country:', reply_markup=get_keyboards()['alphabet'])
+        first_response()
+    elif action in ('letter', 'page'):
+        letter, _, page = value.partition(':')
+        reply_markup = letter_keyboard(letter, int(page) if page.isdigit() else 0)
+        if reply_markup is None:
+            reply_markup = get_keyboards()['alphabet']
+        query.edit_message_text(text='Please choose country:', reply_markup=reply_markup)
+        first_response()
+    else:
+        row = snapshot.rows.get(value)
+        name = value if row is None else row.country_name
+
+        def reply(result):
             if result['type'] == 'image':
                 try:
-                    query.edit_message_text("Country: " + query.data)
-                    if result['source'] == 'cache':
-                        query.message.reply_photo(result['data'])
-                    else:
-                        item = query.message.reply_photo(open(result['data'], 'rb'))
-                        cache_image(parse_string(query.data), item)
-                        print("Image cached")
+                    query.edit_message_text("Country: " + name)
+                    send_photo(query.message, result)
                 except:
                     query.edit_message_text(result['text'])
             elif result['type'] == 'text':
                 query.edit_message_text(result['data'])
-    else:
-        query.edit_message_text(text=f"Selected option: {query.data}")
+            first_response()
+        dispatch_query(name, reply)
 
 
 def help_command(update: Update, context: CallbackContext) -> None:
     update.message.reply_text('Corona count update bot')
 
 
-def Handle(update: Update, context: CallbackContext) -> None:
-    global country_connection
-    if country_connection is None:
-        country_connection = sqlite3.connect('Corona.db')
-    result = data_query(update.message.text)
+# send the card of a query result, caching the file_id of fresh uploads
+def send_photo(message, result):
+    if result['source'] == 'cache':
+        message.reply_photo(result['data'])
+    else:
+        start = time.time()
+        item = message.reply_photo(io.BytesIO(result['data']))
+        upload_time = time.time() - start
+        observe_metric('bot_upload_seconds', upload_time)
+        logger.info("Card of {0} uploaded in {1:.2f}s".format(result['key'][0], upload_time))
+        cache_image(result['key'], item)
+
+
+def send_result(message, result):
     if result['type'] == 'image':
         try:
-            if result['source'] == 'cache':
-                update.message.reply_photo(result['data'])
-            else:
-                item = update.message.reply_photo(open(result['data'], 'rb'))
-                cache_image(parse_string(update.message.text), item)
-                print("Image cached!")
-
+            send_photo(message, result)
         except Exception as d:
-            print(d)
-            update.message.reply_text(result['text'])
+            logger.error(d)
+            message.reply_text(result['text'])
     elif result['type'] == 'text':
-        update.message.reply_text(result['data'])
+        message.reply_text(result['data'])
+    first_response()
+
+
+def Handle(update: Update, context: CallbackContext) -> None:
+    message = update.message
+    dispatch_query(message.text, lambda result: send_result(message, result))
 
 
 def world_update(update: Update, context: CallbackContext) -> None:
-    global country_connection
-    if country_connection is None:
-        country_connection = sqlite3.connect('Corona.db')
-    result = data_query("World")
-    if result['type'] == 'image':
-        try:
-            if result['source'] == 'cache':
-                img = update.message.reply_photo(result['data'])
-                cache_image("World", img)
-            else:
-                update.message.reply_photo(open(result['data'], 'rb'))
-        except:
-            update.message.reply_text(result['text'])
-    elif result['type'] == 'text':
-        update.message.reply_text(result['data'])
+    message = update.message
+    dispatch_query("World", lambda result: send_result(message, result))
+
+
+def trend(update: Update, context: CallbackContext) -> None:
+    """Send the trend chart of a country: /trend <country> [7|30|90]"""
+    args = list(context.args or [])
+    window = trend_default_window
+    if args.__len__() > 0 and args[-1].isdigit():
+        window = int(args.pop())
+    if args.__len__() == 0 or window not in trend_windows:
+        update.message.reply_text("Usage: /trend <country> [7|30|90]\nExample:- /trend Ethiopia 30")
+        return
+    query = " ".join(args)
+    key = resolve_country(query)
+    if key is None:
+        update.message.reply_text(data_query(query)['data'])
+        return
+    item = snapshot.rows[key]
+    message = update.message
+
+    def reply(chart):
+        if chart is None:
+            message.reply_text("Not enough history for " + item['country_name'] + " yet.")
+        elif isinstance(chart, dict):
+            message.reply_text(chart['data'])
+        else:
+            message.reply_photo(io.BytesIO(chart))
+    if not submit_job(('trend', key, window), lambda: trend_chart(get_connection(), item, window), reply):
+        message.reply_text("Too many requests right now, please try again in a moment.")
+
+
+def top(update: Update, context: CallbackContext) -> None:
+    """Rank the countries by a metric: /top <metric> [n]"""
+    args = list(context.args or [])
+    count = top_default
+    if args.__len__() > 0 and args[-1].isdigit():
+        count = int(args.pop())
+    metric = rank_metric(" ".join(args)) if args.__len__() > 0 else None
+    if metric is None or count < 1:
+        update.message.reply_text("Usage: /top <metric> [n]\nMetrics: " + ", ".join(metric_labels.keys()) +
+                                  "\nExample:- /top deaths_per_million 20")
+        return
+    update.message.reply_text(top_table(snapshot, metric, min(count, top_max)), parse_mode='HTML')
+
+
+def compare(update: Update, context: CallbackContext) -> None:
+    """Compare countries side by side: /compare a b c (or a, b, c for names with spaces)"""
+    text = " ".join(context.args or [])
+    queries = [query for query in (text.split(',') if ',' in text else text.split()) if query.strip() != ""]
+    if queries.__len__() < 2 or queries.__len__() > compare_max:
+        update.message.reply_text("Usage: /compare <2 to {0} countries>\nExample:- /compare Ethiopia Kenya "
+                                  "Uganda\nExample:- /compare South Africa, Nigeria".format(compare_max))
+        return
+    current = snapshot
+    keys = []
+    for query in queries:
+        key = resolve_country(query)
+        if key is None:
+            update.message.reply_text(data_query(query.strip())['data'])
+            return
+        if key in current.rows:
+            keys.append(key)
+    update.message.reply_text(compare_table(current, keys), parse_mode='HTML')
+
+
+def subscribe(update: Update, context: CallbackContext) -> None:
+    """Get the card of a country after each update: /subscribe <country> (lists the subscriptions without one)"""
+    chat_id = update.effective_chat.id
+    connection = get_connection()
+    countries = [country for (country,) in connection.execute(
+        "select country from subscription where chat_id=? order by country", (chat_id,))]
+    query = " ".join(context.args or [])
+    if query.strip() == "":
+        names = [snapshot.rows[country].country_name for country in countries if country in snapshot.rows]
+        update.message.reply_text("Subscriptions: " + ", ".join(names) if names.__len__() > 0 else
+                                  "Usage: /subscribe <country>\nExample:- /subscribe Ethiopia")
+        return
+    key = resolve_country(query)
+    if key is None:
+        update.message.reply_text(data_query(query)['data'])
+        return
+    if key not in countries and countries.__len__() >= subscribe_max:
+        update.message.reply_text("You can subscribe to at most " + str(subscribe_max) + " countries.")
+        return
+    item = snapshot.rows[key]
+    with connection:
+        connection.execute("insert or replace into subscription (chat_id, country, update_time) values (?,?,?)",
+                           (chat_id, key, item['update_time']))
+    update.message.reply_text("Subscribed to " + item['country_name'] + ", you will get its card after each "
+                              "update.\n/unsubscribe " + item['country_name'] + " to stop.")
+
+
+def unsubscribe(update: Update, context: CallbackContext) -> None:
+    """Stop the pushes of a country: /unsubscribe <country|all>"""
+    chat_id = update.effective_chat.id
+    query = " ".join(context.args or [])
+    key = 'all' if query.strip().lower() == 'all' else resolve_country(query)
+    if key is None:
+        update.message.reply_text("Usage: /unsubscribe <country|all>")
+        return
+    with get_connection() as connection:
+        if key == 'all':
+            connection.execute("delete from subscription where chat_id=?", (chat_id,))
+            connection.execute("delete from push_queue where chat_id=?", (chat_id,))
+        else:
+            connection.execute("delete from subscription where chat_id=? and country=?", (chat_id, key))
+            connection.execute("delete from push_queue where chat_id=? and country=?", (chat_id, key))
+    update.message.reply_text("Unsubscribed.")
+
+
+def stats(update: Update, context: CallbackContext) -> None:
+    """Show the bot's metrics to admins: /stats"""
+    if not is_admin(update):
+        update.message.reply_text("This command is only available to admins.")
+        return
+    for part in split_message(stats_text()):
+        update.message.reply_text(part)
+
+
+def refresh(update: Update, context: CallbackContext) -> None:
+    """Run a data update now (admins only): /refresh"""
+    if not is_admin(update):
+        update.message.reply_text("This command is only available to admins.")
+        return
+    refresh_event.set()
+    update.message.reply_text("Refresh requested, " + schedule_report(0))
 
 
 def inlinequery(update: Update, context: CallbackContext) -> None:
     """Handle the inline query."""
     query = update.inline_query.query
 
-    if query == "":
+    if query.strip() == "":
         return
 
-    results = [
-        InlineQueryResultArticle(
-            id=str(uuid4()),
-            title="Caps",
-            input_message_content=InputTextMessageContent(query.upper()),
-        ),
-        InlineQueryResultArticle(
-            id=str(uuid4()),
-            title="Bold",
-            input_message_content=InputTextMessageContent(
-                f"*{escape_markdown(query)}*", parse_mode=ParseMode.MARKDOWN
-            ),
-        ),
-        InlineQueryResultArticle(
-            id=str(uuid4()),
-            title="Italic",
-            input_message_content=InputTextMessageContent(
-                f"_{escape_markdown(query)}_", parse_mode=ParseMode.MARKDOWN
-            ),
-        ),
-    ]
-
-    update.inline_query.answer(results)
+    update.inline_query.answer(inline_results(query), cache_time=inline_cache_time)
+
+
+# asyncio runtime: updates arrive on a local webhook server, the event loop only does the connection handling,
+# handlers run on handler_workers threads and renders still go to the render executor.
+# webhook_url is the public address Telegram posts to (registered at startup when set), typically a reverse
+# proxy in front of webhook_host:webhook_port
+webhook_host = os.environ.get("webhook-host", "127.0.0.1")
+webhook_port = int(os.environ.get("webhook-port", "8443"))
+webhook_path = os.environ.get("webhook-path") or \
+    "/" + hashlib.sha256(str(bot_token).encode('utf-8')).hexdigest()[:32]
+webhook_url = os.environ.get("webhook-url")
+webhook_max_body = 1024 * 1024
+handler_workers = int(os.environ.get("handler-workers", "16"))
+
+
+# HTTP/1.1 answer on a webhook connection
+async def write_response(writer, status, reason, body=b""):
+    writer.write("HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\n\r\n".format(
+        status, reason, body.__len__()).encode('latin-1') + body)
+    await writer.drain()
+
+
+# one webhook connection (Telegram keeps them alive): each POST on webhook_path carries one update, which is
+# acknowledged right away and handed to the dispatcher on the handler executor
+async def webhook_connection(reader, writer, dispatcher, executor):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', '0'))
+            if length > webhook_max_body:
+                await write_response(writer, 413, "Payload Too Large")
+                break
+            body = await reader.readexactly(length)
+            if method != 'POST' or path != webhook_path:
+                await write_response(writer, 404, "Not Found")
+                continue
+            try:
+                # a body that isn't an update object: invalid JSON (ValueError), another JSON type or missing
+                # fields (TypeError, AttributeError), or null (no update)
+                update = Update.de_json(json.loads(body.decode('utf-8')), dispatcher.bot)
+            except (ValueError, TypeError, AttributeError):
+                update = None
+            if update is None:
+                await write_response(writer, 400, "Bad Request")
+                continue
+            await write_response(writer, 200, "OK", b"{}")
+            loop.run_in_executor(executor, dispatcher.process_update, update)
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+# scheduled scraping; update_count blocks on requests and sqlite and the scheduler waits on refresh_event, so both
+# run on one update thread (which also keeps one database connection for the writer)
+async def scrape_loop():
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="update")
+
+    delay = await loop.run_in_executor(executor, lambda: start_schedule(get_connection()))
+    while True:
+        await loop.run_in_executor(executor, wait_for_update, delay)
+        delay = await loop.run_in_executor(executor, lambda: run_update(get_connection()))
+
+
+async def main_async(dispatcher):
+    executor = ThreadPoolExecutor(max_workers=handler_workers, thread_name_prefix="handler")
+    server = await asyncio.start_server(lambda reader, writer: webhook_connection(reader, writer, dispatcher, executor),
+                                        webhook_host, webhook_port)
+    logger.info("Webhook: listening on {0}:{1}".format(webhook_host, webhook_port))
+    if webhook_url is not None:
+        await asyncio.get_running_loop().run_in_executor(
+            executor, lambda: dispatcher.bot.set_webhook(webhook_url.rstrip('/') + webhook_path))
+        logger.info("Webhook: registered " + webhook_url)
+    startup_stage('serving')
+    start_warm_caches()
+    scraper = asyncio.ensure_future(scrape_loop())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        scraper.cancel()
+        executor.shutdown(wait=False)
+
+
+def add_handlers(dispatcher):
+    dispatcher.add_handler(CommandHandler("start", instrumented("start", start)))
+    dispatcher.add_handler(CommandHandler("update", instrumented("update", world_update, deferred=True)))
+    dispatcher.add_handler(CommandHandler("trend", instrumented("trend", trend)))
+    dispatcher.add_handler(CommandHandler("top", instrumented("top", top)))
+    dispatcher.add_handler(CommandHandler("compare", instrumented("compare", compare)))
+    dispatcher.add_handler(CommandHandler("subscribe", instrumented("subscribe", subscribe)))
+    dispatcher.add_handler(CommandHandler("unsubscribe", instrumented("unsubscribe", unsubscribe)))
+    dispatcher.add_handler(CommandHandler("list", instrumented("list", countries_list)))
+    dispatcher.add_handler(CallbackQueryHandler(instrumented("button", button, deferred=True)))
+    dispatcher.add_handler(CommandHandler("help", instrumented("help", help_command)))
+    dispatcher.add_handler(CommandHandler("stats", instrumented("stats", stats)))
+    dispatcher.add_handler(CommandHandler("refresh", instrumented("refresh", refresh)))
+
+    dispatcher.add_handler(InlineQueryHandler(instrumented("inline", inlinequery)))
+
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command,
+                                          instrumented("message", Handle, deferred=True)))
 
 
 def main() -> None:
     load_data()
+    load_image_cache()
+    rebuild_resolver()
+    start_render_executor()
+    start_metrics_server()
+
+    if runtime == 'asyncio':
+        # one pooled Bot API connection per thread that can reply: handlers and reply workers
+        request = Request(con_pool_size=handler_workers + reply_workers + 4)
+        dispatcher = Dispatcher(Bot(bot_token, base_url=bot_api_url, request=request), queue.Queue())
+        add_handlers(dispatcher)
+        start_push(dispatcher.bot)
+        asyncio.run(main_async(dispatcher))
+        return
+
+    # the push tables and push_bot have to exist before the first update enqueues pushes
+    updater = Updater(bot_token, base_url=bot_api_url)
+    add_handlers(updater.dispatcher)
+    start_push(updater.bot)
+
     update_thread = threading.Thread(target=count_update)
     logger.info("Database update thread initialized")
     logger.info("Database update thread started")
     update_thread.start()
 
-    updater = Updater(bot_token)
-    dispatcher = updater.dispatcher
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("update", world_update))
-    dispatcher.add_handler(CommandHandler("list", countries_list))
-    updater.dispatcher.add_handler(CallbackQueryHandler(button))
-    dispatcher.add_handler(CommandHandler("help", help_command))
-
-    dispatcher.add_handler(InlineQueryHandler(inlinequery))
-
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, Handle))
     updater.start_polling()
+    startup_stage('serving')
+    start_warm_caches()
 
     updater.idle()
 
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:2] == ['backfill']:
+        backfill(sys.argv[2:])
+    else:
+        main()
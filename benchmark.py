@@ -0,0 +1,334 @@
+import argparse
+import glob
+import gzip
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import UpdateCount
+
+
+# load a saved page (plain or gzipped html)
+def load_fixture(path):
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rt', encoding='utf-8') as fixture_file:
+            return fixture_file.read()
+    with open(path, encoding='utf-8') as fixture_file:
+        return fixture_file.read()
+
+
+# offline fake: Telegram messages just record replies (pages are replayed from fixtures)
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    def reply_text(self, text, reply_markup=None):
+        self.replies.append((text, reply_markup))
+
+    def reply_photo(self, photo):
+        self.replies.append(photo)
+        return {'photo': [{'file_id': 'benchmark'}]}
+
+
+class FakeCallbackQuery:
+    def __init__(self, data):
+        self.data = data
+        self.message = FakeMessage()
+
+    def answer(self):
+        pass
+
+    def edit_message_text(self, text, reply_markup=None):
+        self.message.replies.append((text, reply_markup))
+
+
+class FakeUpdate:
+    def __init__(self, data=None):
+        self.message = FakeMessage()
+        self.callback_query = FakeCallbackQuery(data)
+
+
+# percentile of sorted samples (nearest rank)
+def percentile(samples, p):
+    return samples[min(samples.__len__() - 1, int(round(p / 100.0 * (samples.__len__() - 1))))]
+
+
+# run op once under tracemalloc for the peak memory, then repeat times for latency; setup runs untimed before
+# every call, throughput counts ops units of work per call
+def measure(case, op, repeat, setup=None, ops=1):
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    op()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        op()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    result = {'case': case, 'runs': repeat, 'p50_ms': percentile(samples, 50) * 1000,
+              'p99_ms': percentile(samples, 99) * 1000, 'throughput': repeat * ops / sum(samples),
+              'peak_kb': peak / 1024}
+    print("  {case:<24} {runs:>5} runs  p50 {p50_ms:9.3f} ms  p99 {p99_ms:9.3f} ms  {throughput:10.1f} ops/s  "
+          "peak {peak_kb:9.1f} KB".format(**result))
+    return result
+
+
+# work on a copy of the database so benchmarks never write to Corona.db
+def prepare_data(workdir):
+    UpdateCount.database_path = os.path.join(workdir, 'Corona.db')
+    shutil.copy('Corona.db', UpdateCount.database_path)
+    UpdateCount.card_store_dir = None
+    UpdateCount.load_data()
+    UpdateCount.load_image_cache()
+    UpdateCount.rebuild_resolver()
+
+
+def bench_parse(fixtures, repeat):
+    results = []
+    for path in fixtures:
+        html = load_fixture(path)
+        print("{0} ({1:.1f} KB)".format(path, html.__len__() / 1024))
+        rows = {}
+        for name, backend in UpdateCount.parse_backends.items():
+            rows[name] = list(backend(html))
+            results.append(measure('parse.' + name, lambda: list(backend(html)), repeat))
+        print("  rows {0}".format("match" if rows['soup'] == rows['stream'] else "DIFFER"))
+    return results
+
+
+# update_count replaying a fixture page: parse, diff against the loaded snapshot and write, without the network
+def bench_update(fixtures, repeat):
+    results = []
+    base = UpdateCount.snapshot
+    connection = UpdateCount.get_connection()
+    UpdateCount.setup_database(connection)
+    source, start_prerender = UpdateCount.ingest_source, UpdateCount.start_prerender
+
+    def reset():
+        UpdateCount.snapshot = base
+        UpdateCount.ingest_source.position = 0
+        UpdateCount.ingest_source.page_hash = None
+        UpdateCount.row_hashes.clear()
+
+    try:
+        UpdateCount.start_prerender = lambda: None
+        for path in fixtures:
+            UpdateCount.ingest_source = UpdateCount.ReplaySource([path])
+            print(path)
+            results.append(measure('update_count', lambda: UpdateCount.update_count(connection.cursor(), connection),
+                                   repeat, reset))
+    finally:
+        UpdateCount.ingest_source, UpdateCount.start_prerender = source, start_prerender
+        UpdateCount.snapshot = base
+    return results
+
+
+# data_query resolving a name, an alias and an unknown country; the cards are placeholders in the render cache, so
+# only the resolution and the reply are timed (and the card template isn't needed)
+def bench_lookup(repeat):
+    keys = []
+    for query in ('Ethiopia', 'United States'):
+        item = UpdateCount.snapshot.rows[UpdateCount.resolve_country(query)]
+        keys.append((item['country'], item['update_time']))
+    for key in keys:
+        UpdateCount.render_cache[key] = b'card'
+    try:
+        return [measure('lookup.hit', lambda: UpdateCount.data_query('Ethiopia'), repeat),
+                measure('lookup.alias', lambda: UpdateCount.data_query('United States'), repeat),
+                measure('lookup.miss', lambda: UpdateCount.data_query('Atlantis'), repeat)]
+    finally:
+        for key in keys:
+            UpdateCount.render_cache.pop(key, None)
+
+
+# fetch_image rendering a card (cold) and serving it from the render cache (warm)
+def bench_fetch_image(repeat):
+    item = UpdateCount.snapshot.rows['ethiopia']
+    key = (item['country'], item['update_time'])
+    UpdateCount.image_cache.pop(key, None)
+
+    def clear():
+        UpdateCount.render_cache.pop(key, None)
+
+    cold = measure('fetch_image.cold', lambda: UpdateCount.fetch_image('Ethiopia', item), max(repeat // 10, 1), clear)
+    warm = measure('fetch_image.warm', lambda: UpdateCount.fetch_image('Ethiopia', item), repeat)
+    return [cold, warm]
+
+
+# end-to-end response time of a card request per card-format: a cold fetch_image (render and encode) plus the
+# upload of the encoded card at uplink_mbps
+def bench_formats(formats, repeat, uplink_mbps):
+    item = UpdateCount.snapshot.rows['ethiopia']
+    key = (item['country'], item['update_time'])
+    UpdateCount.image_cache.pop(key, None)
+
+    def clear():
+        UpdateCount.render_cache.pop(key, None)
+
+    configured = UpdateCount.card_format
+    results = []
+    try:
+        for image_format in formats:
+            UpdateCount.card_format = image_format
+            result = measure('format.' + image_format, lambda: UpdateCount.fetch_image('Ethiopia', item), repeat,
+                             clear)
+            result['bytes'] = UpdateCount.render_cache[key].__len__()
+            result['upload_ms'] = result['bytes'] * 8 / (uplink_mbps * 1000.0)
+            result['response_ms'] = result['p50_ms'] + result['upload_ms']
+            print("  {0:<24} {1:>8} bytes  upload {2:9.3f} ms  response {3:9.3f} ms".format(
+                '', result['bytes'], result['upload_ms'], result['response_ms']))
+            results.append(result)
+    finally:
+        UpdateCount.card_format = configured
+        UpdateCount.render_cache.pop(key, None)
+    if results.__len__() > 0:
+        best = min(results, key=lambda r: r['response_ms'])
+        print("  fastest response at {0} Mbit/s: {1}".format(uplink_mbps, best['case'][len('format.'):]))
+    return results
+
+
+# every card of the snapshot rendered by the pre-render thread pool
+def bench_catalog(repeat):
+    items = list(UpdateCount.snapshot.rows.values())
+    print("  {0} cards, {1} threads".format(items.__len__(), UpdateCount.render_workers))
+    return [measure('catalog', lambda: UpdateCount.prerender_threads(UpdateCount.render_generation, items),
+                    repeat, UpdateCount.render_cache.clear, items.__len__())]
+
+
+# /list and its callbacks, with the keyboard index rebuilt (cold) and reused (warm)
+def bench_keyboards(repeat):
+    def clear():
+        UpdateCount.keyboard_index = None
+
+    def browse():
+        UpdateCount.countries_list(FakeUpdate(), None)
+        for data in ('letter:S', 'page:S:1', 'letters'):
+            UpdateCount.button(FakeUpdate(data), None)
+
+    return [measure('keyboards.cold', browse, repeat, clear),
+            measure('keyboards.warm', browse, repeat)]
+
+
+# full catalog rendered by the render farm with each worker count, speedup relative to the first count
+def bench_render_farm(process_counts):
+    items = list(UpdateCount.snapshot.rows.values())
+    results = []
+    base = None
+    for processes in process_counts:
+        start = time.perf_counter()
+        rendered = sum(1 for _, content in UpdateCount.render_farm(items, processes) if content is not None)
+        elapsed = time.perf_counter() - start
+        rate = rendered / elapsed
+        base = base or rate
+        print("  {0:>2} processes  {1:>4} cards  {2:7.2f} s  {3:6.1f} cards/s  speedup {4:.2f}x".format(
+            processes, rendered, elapsed, rate, rate / base))
+        results.append({'case': 'render_farm.' + str(processes), 'runs': 1, 'p50_ms': elapsed * 1000,
+                        'p99_ms': elapsed * 1000, 'throughput': rate, 'peak_kb': None})
+    return results
+
+
+# p50 of each case against the baseline, returns the cases slower than threshold times the baseline
+def compare(results, baseline, threshold):
+    previous = {result['case']: result for result in baseline['results']}
+    regressions = []
+    print("compared to baseline of " + baseline['time'] + " (fixtures: " + ", ".join(baseline.get('fixtures', ['?'])) +
+          ")")
+    for result in results:
+        old = previous.get(result['case'])
+        if old is None:
+            continue
+        ratio = result['p50_ms'] / old['p50_ms'] if old['p50_ms'] > 0 else 1.0
+        slower = ratio > threshold
+        if slower:
+            regressions.append(result['case'])
+        print("  {0:<24} p50 {1:9.3f} ms -> {2:9.3f} ms  {3:6.2f}x{4}".format(
+            result['case'], old['p50_ms'], result['p50_ms'], ratio, "  REGRESSION" if slower else ""))
+    return regressions
+
+
+cases = ['parse', 'update', 'lookup', 'fetch-image', 'formats', 'catalog', 'keyboards', 'render-farm']
+default_cases = ['parse', 'update', 'lookup', 'fetch-image', 'keyboards']
+# render cases need the card template, which is not part of the repository
+background_path = os.path.join('image', 'background.jpg')
+render_cases = ['fetch-image', 'formats', 'catalog', 'render-farm']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Corona Update bot benchmarks, offline (fixture page, fake Telegram)")
+    parser.add_argument('cases', nargs='*', default=default_cases, help="one or more of " + ", ".join(cases))
+    parser.add_argument('--fixtures', nargs='*', default=sorted(glob.glob('fixtures/*.html*')),
+                        help="saved pages (plain or gzipped html) of the parse and update cases; the checked-in "
+                             "one is a synthetic page in the worldometers layout, not a real save")
+    parser.add_argument('--repeat', type=int, default=100)
+    parser.add_argument('--processes', type=int, nargs='*',
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument('--formats', nargs='*', default=['png', 'png:1', 'png8', 'webp', 'jpeg'],
+                        help="card-format values of the formats case")
+    parser.add_argument('--uplink-mbps', type=float, default=10.0, help="upload bandwidth of the formats case")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', default='benchmark-baseline.json', help="JSON results to compare against")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="p50 ratio to the baseline above which a case counts as a regression")
+    args = parser.parse_args()
+    for case in args.cases:
+        if case not in cases:
+            parser.error("unknown case " + case)
+    for image_format in args.formats:
+        try:
+            UpdateCount.parse_card_format(image_format)
+        except ValueError as e:
+            parser.error(str(e))
+    logging.getLogger().setLevel(logging.WARNING)
+
+    workdir = tempfile.mkdtemp(prefix='corona-bench-')
+    results = []
+    try:
+        prepare_data(workdir)
+        for case in args.cases:
+            print(case)
+            if case in render_cases and not os.path.exists(background_path):
+                print("  skipped, " + background_path + " is missing")
+                continue
+            if case == 'parse':
+                results += bench_parse(args.fixtures, args.repeat)
+            elif case == 'update':
+                results += bench_update(args.fixtures, max(args.repeat // 10, 1))
+            elif case == 'lookup':
+                results += bench_lookup(args.repeat)
+            elif case == 'fetch-image':
+                results += bench_fetch_image(args.repeat)
+            elif case == 'formats':
+                results += bench_formats(args.formats, max(args.repeat // 10, 1), args.uplink_mbps)
+            elif case == 'catalog':
+                results += bench_catalog(max(args.repeat // 100, 1))
+            elif case == 'keyboards':
+                results += bench_keyboards(args.repeat)
+            elif case == 'render-farm':
+                results += bench_render_farm(args.processes)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'time': str(UpdateCount.datetime.now()).split(".")[0], 'python': sys.version.split()[0],
+              'cpus': os.cpu_count(), 'fixtures': [os.path.basename(path) for path in args.fixtures],
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    if args.baseline and os.path.exists(args.baseline) and args.baseline != args.output:
+        with open(args.baseline) as baseline_file:
+            if compare(results, json.load(baseline_file), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()